@@ -0,0 +1,506 @@
+"""
+Нагрузочный тест бота: локальная заглушка Telegram Bot API, Postgres и генератор трафика.
+
+Настоящие обработчики из main.py получают обновления через long polling
+от заглушки, а время пересылки измеряется по запросам, которые бот
+отправляет обратно. Результат печатается в JSON, чтобы запуски можно было сравнивать.
+
+Примеры:
+    python benchmark.py --database-url postgresql://localhost/bench --users 200 --admins 5
+    python benchmark.py --embedded-postgres --rate-429 0.05 --output bench_output.txt
+
+--embedded-postgres поднимает временный сервер через пакет pgserver (pip install pgserver).
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+from aiohttp import web
+
+BENCH_TOKEN = "123456:BENCHbenchBENCHbenchBENCHbench"
+BENCH_GROUP_ID = -1001000000001
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class FakeTelegramServer:
+    """
+    Заглушка Bot API: getUpdates, sendMessage, sendPhoto, copyMessage, sendMediaGroup,
+    createForumTopic и служебные методы. Умеет добавлять задержку, ответы 429
+    и ошибку "message thread not found".
+    """
+
+    def __init__(self, latency=0.0, rate_429=0.0, rate_thread_not_found=0.0, seed=0):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rate_thread_not_found = rate_thread_not_found
+        self.random = random.Random(seed)
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000)
+        self.topic_ids = itertools.count(10)
+        # (группа, topic_id) созданных топиков
+        self.topics = []
+        self.new_updates = asyncio.Event()
+        # (chat_id, message_id) исходного сообщения -> время отправки боту
+        self.injected = {}
+        self.relay_latencies = []
+        self.relayed = 0
+        self.last_relay_at = None
+        self.calls = {}
+        self.faults = {"429": 0, "thread_not_found": 0, "5xx": 0, "deleted_topic": 0}
+        # (группа, topic_id) топиков, удалённых "вручную" в группе
+        self.deleted_topics = set()
+        # До этого момента (time.monotonic) API отвечает 502, как при сбое Telegram
+        self.outage_until = 0.0
+        self.relay_done = asyncio.Event()
+        self.expected_relays = 0
+
+    # --- генерация обновлений ---
+
+    def push_message(self, chat, from_user, text, message_thread_id=None, edit_of=None):
+        message_id = edit_of or next(self.message_ids)
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": from_user,
+            "text": text,
+        }
+        if message_thread_id is not None:
+            message["message_thread_id"] = message_thread_id
+            message["is_topic_message"] = True
+        if edit_of is not None:
+            message["edit_date"] = int(time.time())
+            self.updates.append({"update_id": next(self.update_ids), "edited_message": message})
+        else:
+            self.updates.append({"update_id": next(self.update_ids), "message": message})
+            self.injected[(chat["id"], message_id)] = time.monotonic()
+        self.new_updates.set()
+        return message_id
+
+    def push_user_message(self, user_id, text):
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        self.push_message({"id": user_id, "type": "private"}, user, text)
+
+    def push_admin_message(self, admin_id, group_id, topic_id, text, edit_of=None):
+        admin = {"id": admin_id, "is_bot": False, "first_name": f"admin{admin_id}"}
+        chat = {"id": group_id, "type": "supergroup", "is_forum": True}
+        return self.push_message(chat, admin, text, message_thread_id=topic_id, edit_of=edit_of)
+
+    # --- HTTP ---
+
+    def _ok(self, result):
+        return web.json_response({"ok": True, "result": result})
+
+    def _message(self, chat_id, **extra):
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private" if int(chat_id) > 0 else "supergroup"},
+            **extra,
+        }
+
+    def _fault(self, params):
+        if time.monotonic() < self.outage_until:
+            self.faults["5xx"] += 1
+            return web.json_response(
+                {"ok": False, "error_code": 502, "description": "Bad Gateway"}, status=502
+            )
+        if self.rate_429 and self.random.random() < self.rate_429:
+            self.faults["429"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+        if (params.get("message_thread_id") and self.rate_thread_not_found
+                and self.random.random() < self.rate_thread_not_found):
+            self.faults["thread_not_found"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 400,
+                "description": "Bad Request: message thread not found",
+            })
+        return None
+
+    def _record_relay(self, params):
+        key = (int(params["from_chat_id"]), int(params["message_id"]))
+        started = self.injected.pop(key, None)
+        if started is None:
+            return
+        self.last_relay_at = time.monotonic()
+        self.relay_latencies.append(self.last_relay_at - started)
+        self.relayed += 1
+        if self.relayed >= self.expected_relays:
+            self.relay_done.set()
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = min(float(params.get("timeout") or 0), 1.0)
+        pending = [update for update in self.updates if update["update_id"] >= offset]
+        if not pending and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            pending = [update for update in self.updates if update["update_id"] >= offset]
+        # Подтверждённые обновления больше не нужны
+        self.updates = pending
+        return self._ok(pending[:100])
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getUpdates":
+            return await self.get_updates(params)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        thread_id = params.get("message_thread_id")
+        if thread_id and (int(params["chat_id"]), int(thread_id)) in self.deleted_topics:
+            self.faults["deleted_topic"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 400,
+                "description": "Bad Request: message thread not found",
+            })
+        if method == "getMe":
+            return self._ok({"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"})
+        if method in ("deleteWebhook", "deleteForumTopic", "sendChatAction", "setWebhook"):
+            return self._ok(True)
+        if method == "createForumTopic":
+            topic_id = next(self.topic_ids)
+            self.topics.append((int(params["chat_id"]), topic_id))
+            return self._ok({"message_thread_id": topic_id, "name": params.get("name", ""), "icon_color": 0})
+
+        fault = self._fault(params)
+        if fault is not None:
+            return fault
+        if method == "copyMessage":
+            self._record_relay(params)
+            return self._ok({"message_id": next(self.message_ids)})
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            return self._ok([self._message(params["chat_id"]) for _ in media])
+        if method.startswith("send") or method.startswith("edit"):
+            return self._ok(self._message(params.get("chat_id", BENCH_GROUP_ID), text=params.get("text")))
+        return web.json_response({"ok": False, "error_code": 404, "description": "Not Found"})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+
+async def start_fake_server(server):
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def configure_environment(args, database_url):
+    # main.py читает настройки при импорте, поэтому задаём их заранее
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["BOT_TOKEN"] = BENCH_TOKEN
+    os.environ["GROUP_ID"] = str(BENCH_GROUP_ID)
+    os.environ["GROUP_IDS"] = ",".join(str(BENCH_GROUP_ID - index) for index in range(args.groups))
+    os.environ["GROUP_ASSIGNMENT"] = args.group_assignment
+    os.environ["TABLE_NAME"] = args.table
+    os.environ.setdefault("ENCRYPTION_KEY", "0123456789abcdef")
+    os.environ.setdefault("BLIND_INDEX_KEY", "bench-blind-index-key")
+    os.environ["METRICS_PORT"] = "0"
+    os.environ["RETRY_BASE_DELAY"] = "0.2"
+    os.environ.setdefault("CIRCUIT_OPEN_SECONDS", "1")
+    os.environ["LOG_LEVEL"] = args.log_level
+    os.environ["LOG_FORMAT"] = args.log_format
+    os.environ["LOG_QUEUE"] = "0" if args.log_sync else "1"
+    os.environ["LOG_SAMPLE"] = args.log_sample
+    if args.log_file:
+        os.environ["LOG_FILE"] = args.log_file
+    if not args.realistic_limits:
+        # Меряем код бота, а не ограничения Telegram
+        os.environ["RATE_LIMIT_GLOBAL"] = "100000"
+        os.environ["RATE_LIMIT_CHAT"] = "100000"
+        os.environ["RATE_LIMIT_GROUP_PER_MINUTE"] = "6000000"
+        os.environ["TOPIC_CREATE_PER_MINUTE"] = "600000"
+        os.environ["TOPIC_CHECK_RATE"] = "10000"
+
+
+async def drop_bench_tables(main):
+    async with main.db_acquire() as conn:
+        for table in (main.OUTBOX_TABLE, main.MESSAGE_MAP_TABLE, main.BROADCAST_TABLE, main.TOPIC_REPLACEMENTS_TABLE, main.SCHEMA_MIGRATIONS_TABLE, main.TABLE_NAME):
+            await conn.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
+
+
+async def run_benchmark(args, database_url):
+    configure_environment(args, database_url)
+    from aiogram.client.telegram import TelegramAPIServer
+    import main
+
+
+    server = FakeTelegramServer(args.latency, args.rate_429, args.rate_thread_not_found, args.seed)
+    runner, base_url = await start_fake_server(server)
+    # "default" — стандартная сессия aiogram, как до настройки пула и кодека
+    main.bot.session = main.create_bot_session(tuned=args.session == "tuned", json_codec=args.json_codec)
+    main.bot.session.api = TelegramAPIServer.from_base(base_url)
+
+    main.db_pool2 = await main.get_db_pool2()
+    await main.run_migrations()
+    await main.message_map.maintain()
+    await main.topic_reconciler.load_replacements()
+    main.outbox.start()
+    main.message_map.start()
+    # Проверка по расписанию здесь не нужна: при --check-topics проход запускается явно
+    main.topic_reconciler.start(database_url, check_interval=0)
+    retry_task = asyncio.create_task(main.retry_scheduler.run())
+    polling = asyncio.create_task(main.dp.start_polling(
+        main.bot, handle_signals=False, close_bot_session=False, polling_timeout=1
+    ))
+
+    users = [100000 + index for index in range(args.users)]
+    admins = [900000 + index for index in range(args.admins)]
+    rng = random.Random(args.seed)
+    admin_messages = []
+    try:
+        # Регистрация: /start от каждого пользователя
+        for user_id in users:
+            server.push_user_message(user_id, "/start")
+        while len(server.topics) < len(users):
+            await asyncio.sleep(0.05)
+        # Топики, удалённые в группе до начала трафика
+        server.deleted_topics.update(rng.sample(server.topics, min(args.deleted_topics, len(server.topics))))
+        topic_check_s = None
+        if args.check_topics:
+            check_started = time.monotonic()
+            await main.topic_reconciler.check(database_url)
+            while main.topic_reconciler.dead:
+                await asyncio.sleep(0.01)
+            topic_check_s = round(time.monotonic() - check_started, 3)
+
+        server.expected_relays = args.users * args.messages + args.admins * args.replies
+        queries_before = main.metrics.total("db_query_duration_seconds")
+        started = time.monotonic()
+        server.outage_until = started + args.outage
+        for round_number in range(max(args.messages, args.replies)):
+            if round_number < args.messages:
+                for user_id in users:
+                    server.push_user_message(user_id, f"сообщение {round_number}")
+            if round_number < args.replies:
+                for admin_id in admins:
+                    group_id, topic_id = rng.choice(
+                        [topic for topic in server.topics if topic not in server.deleted_topics]
+                    )
+                    admin_messages.append((admin_id, group_id, topic_id, server.push_admin_message(
+                        admin_id, group_id, topic_id, f"ответ {round_number}"
+                    )))
+            if args.interval:
+                await asyncio.sleep(args.interval)
+        try:
+            await asyncio.wait_for(server.relay_done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        # Время до последней доставленной пересылки: недошедшие сообщения не растягивают замер
+        elapsed = (server.last_relay_at or time.monotonic()) - started
+        queries = main.metrics.total("db_query_duration_seconds") - queries_before
+
+        # Правки ответов администраторов: каждая должна стать одним editMessageText
+        edits = admin_messages[:args.edits]
+        copies_before = server.calls.get("copyMessage", 0)
+        for admin_id, group_id, topic_id, message_id in edits:
+            server.push_admin_message(admin_id, group_id, topic_id, "исправленный ответ", edit_of=message_id)
+        deadline = time.monotonic() + args.timeout
+        while server.calls.get("editMessageText", 0) < len(edits) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        edit_calls = {
+            "edits": len(edits),
+            "editMessageText": server.calls.get("editMessageText", 0),
+            "copyMessage": server.calls.get("copyMessage", 0) - copies_before,
+        }
+        log_call_us = await benchmark_log_call(main)
+    finally:
+        await main.dp.stop_polling()
+        await polling
+        retry_task.cancel()
+        await main.outbox.flush()
+        await main.message_map.flush()
+        if not args.keep_tables:
+            await drop_bench_tables(main)
+        await main.db_pool2.close()
+        await main.bot.session.close()
+        await runner.cleanup()
+
+    latencies_ms = [value * 1000 for value in server.relay_latencies]
+    return {
+        "config": {
+            "users": args.users,
+            "admins": args.admins,
+            "messages_per_user": args.messages,
+            "replies_per_admin": args.replies,
+            "api_latency_s": args.latency,
+            "rate_429": args.rate_429,
+            "rate_thread_not_found": args.rate_thread_not_found,
+            "outage_s": args.outage,
+            "deleted_topics": args.deleted_topics,
+            "check_topics": args.check_topics,
+            "logging": {
+                "level": args.log_level,
+                "format": args.log_format,
+                "queue": not args.log_sync,
+                "sample": args.log_sample,
+            },
+            "realistic_limits": args.realistic_limits,
+            "session": args.session,
+            "groups": args.groups,
+            "group_assignment": args.group_assignment,
+            "json_codec": main.load_json_codec(args.json_codec)[0],
+        },
+        "expected_relays": server.expected_relays,
+        "relayed": server.relayed,
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_second": round(server.relayed / elapsed, 2) if elapsed else None,
+        "relay_latency_ms": {
+            "p50": percentile(latencies_ms, 0.5),
+            "p99": percentile(latencies_ms, 0.99),
+            "max": max(latencies_ms) if latencies_ms else None,
+        },
+        "db_queries_per_message": round(queries / server.relayed, 3) if server.relayed else None,
+        "topics_per_group": dict(collections.Counter(str(group_id) for group_id, _ in server.topics)),
+        "api_calls": server.calls,
+        "faults": server.faults,
+        "circuit_breaker": main.api_breaker.stats(),
+        "topic_reconciler": {**main.topic_reconciler.stats(), "check_s": topic_check_s},
+        "identity_cache": main.identity_cache.stats(),
+        "admin_edits": edit_calls,
+        "message_map": main.message_map.stats(),
+        "json_codecs": benchmark_json_codecs(main),
+        "log_call_us": log_call_us,
+    }
+
+
+async def benchmark_log_call(main, iterations=1000):
+    """
+    Сколько микросекунд цикл событий тратит на одну типичную запись о пересылке.
+    Между записями цикл свободен, как в работе бота: поток очереди логов успевает их записать.
+    """
+    spent = 0.0
+    for index in range(iterations):
+        started = time.perf_counter()
+        main.relay_log.info("Сообщение от %s: %s", main.UserRef(100000 + index), "text")
+        spent += time.perf_counter() - started
+        await asyncio.sleep(0.001)
+    return round(spent / iterations * 1e6, 2)
+
+
+def benchmark_json_codecs(main, iterations=200):
+    """Время разбора и сериализации типичного ответа getUpdates (100 сообщений) для каждого кодека."""
+    payload = {"ok": True, "result": [
+        {"update_id": index, "message": {
+            "message_id": index, "date": 1700000000,
+            "chat": {"id": 100000 + index, "type": "private"},
+            "from": {"id": 100000 + index, "is_bot": False, "first_name": "Пользователь"},
+            "text": "Привет! Это тестовое сообщение для замера JSON-кодека." * 2,
+        }} for index in range(100)
+    ]}
+    results = {}
+    for name in ("json", "ujson", "orjson"):
+        codec_name, loads, dumps = main.load_json_codec(name)
+        if codec_name != name:
+            continue
+        text = dumps(payload)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            loads(text)
+        loads_time = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in range(iterations):
+            dumps(payload)
+        dumps_time = time.perf_counter() - started
+        results[name] = {
+            "loads_us": round(loads_time / iterations * 1e6, 1),
+            "dumps_us": round(dumps_time / iterations * 1e6, 1),
+        }
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"))
+    parser.add_argument("--embedded-postgres", action="store_true",
+                        help="поднять временный Postgres через pgserver")
+    parser.add_argument("--table", default=f"bench_users_{uuid.uuid4().hex[:8]}")
+    parser.add_argument("--keep-tables", action="store_true")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--admins", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=10, help="сообщений от каждого пользователя")
+    parser.add_argument("--replies", type=int, default=10, help="ответов от каждого администратора")
+    parser.add_argument("--interval", type=float, default=0.0, help="пауза между раундами, с")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка заглушки API, с")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-thread-not-found", type=float, default=0.0)
+    parser.add_argument("--outage", type=float, default=0.0,
+                        help="первые N секунд нагрузки API отвечает 502 (проверка выключателя)")
+    parser.add_argument("--deleted-topics", type=int, default=0,
+                        help="сколько топиков удалить в группе перед началом трафика")
+    parser.add_argument("--check-topics", action="store_true",
+                        help="перед трафиком проверить все топики фоновой проверкой")
+    parser.add_argument("--realistic-limits", action="store_true",
+                        help="не отключать ограничитель частоты отправки")
+    parser.add_argument("--session", choices=("tuned", "default"), default="tuned",
+                        help="default — стандартная сессия aiogram для сравнения")
+    parser.add_argument("--json-codec", default="auto", help="auto, orjson, ujson или json")
+    parser.add_argument("--groups", type=int, default=1, help="число групп с топиками (GROUP_IDS)")
+    parser.add_argument("--group-assignment", choices=("hash", "least_loaded"), default="hash")
+    parser.add_argument("--edits", type=int, default=20, help="сколько ответов администраторов затем отредактировать")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--log-format", choices=("text", "json"), default="text")
+    parser.add_argument("--log-file", help="куда писать логи бота (например /dev/null для замера накладных расходов)")
+    parser.add_argument("--log-sync", action="store_true", help="писать логи прямо из цикла событий, без очереди")
+    parser.add_argument("--log-sample", default="", help='например "bot.relay=0.01"')
+    parser.add_argument("--output", help="файл для JSON-результата (по умолчанию stdout)")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    database_url = args.database_url
+    embedded = None
+    if args.embedded_postgres:
+        import pgserver
+        embedded = pgserver.get_server(tempfile.mkdtemp(prefix="bench-pg-"), cleanup_mode="stop")
+        database_url = embedded.get_uri()
+    if not database_url:
+        sys.exit("Укажите --database-url, BENCH_DATABASE_URL или --embedded-postgres")
+    try:
+        result = asyncio.run(run_benchmark(args, database_url))
+    finally:
+        if embedded is not None:
+            embedded.cleanup()
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main_cli()
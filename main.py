@@ -1,23 +1,213 @@
 import asyncio
+import atexit
+import bisect
+import contextlib
+import heapq
+import itertools
+import random
 import signal
-from asyncio import Lock
+import socket
+import time
+from collections import OrderedDict, namedtuple, deque
+from datetime import datetime, timedelta, timezone
 import asyncpg
+from aiohttp import web
 import os
 import uuid
 import logging
-from aiogram import Bot, Dispatcher, F, types
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from aiogram.filters import Command
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
+from aiogram.client.default import Default
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError,
+)
+from aiogram.enums import ChatMemberStatus, ContentType
+from aiogram.types import (
+    ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, TelegramObject, ReplyParameters,
+    InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio,
+)
+from aiogram.filters import Command, CommandObject
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad, unpad
 import base64
-
-logging.basicConfig(level=logging.DEBUG)
+import functools
+import hashlib
+import hmac
+import json
+import sys
 
 # Загрузка данных из .env
 load_dotenv()
 
+# Настройки логирования
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Уровни отдельных логгеров, например "aiogram.event=INFO,asyncpg=DEBUG"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "aiogram.event=WARNING,asyncpg=WARNING,aiohttp.access=WARNING")
+# Доля записей уровня ниже WARNING, которая попадает в лог, например "bot.relay=0.01"
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text или json
+LOG_FILE = os.getenv("LOG_FILE")  # по умолчанию stderr
+LOG_QUEUE = os.getenv("LOG_QUEUE", "1") not in ("0", "false", "no")
+# Telegram ID в логах заменяются коротким слепым индексом
+LOG_REDACT_IDS = os.getenv("LOG_REDACT_IDS", "1") not in ("0", "false", "no")
+
+
+def _parse_settings(value):
+    settings = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, setting = item.partition("=")
+        settings[name.strip()] = setting.strip()
+    return settings
+
+
+class UserRef:
+    """
+    Telegram ID в аргументах лога. Превращается в строку только при записи
+    (в потоке логирования); при LOG_REDACT_IDS вместо ID выводится начало
+    слепого индекса — записи одного пользователя можно сопоставить, но не раскрыть.
+    """
+
+    __slots__ = ("telegram_id",)
+
+    def __init__(self, telegram_id):
+        self.telegram_id = telegram_id
+
+    def __str__(self):
+        if not LOG_REDACT_IDS:
+            return str(self.telegram_id)
+        return f"user:{blind_index(self.telegram_id).hex()[:10]}"
+
+    __repr__ = __str__
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает долю rate записей логгера и его потомков (LOG_SAMPLE).
+    Предупреждения и ошибки не отбрасываются никогда.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = {name: float(rate) for name, rate in rates.items()}
+        self._resolved = {}
+        self.dropped = 0
+
+    def _rate(self, name):
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate = 1.0
+            parts = name.split(".")
+            for index in range(len(parts), 0, -1):
+                prefix = ".".join(parts[:index])
+                if prefix in self.rates:
+                    rate = self.rates[prefix]
+                    break
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self._rate(record.name)
+        if rate >= 1 or random.random() < rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: для сборщиков логов."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _UserSlot:
+    """Место UserRef в сообщении, подставленном в prepare."""
+
+    __slots__ = ()
+    MARK = "\x00user\x00"
+
+    def __str__(self):
+        return self.MARK
+
+    __repr__ = __str__
+
+
+class LoopQueueHandler(QueueHandler):
+    """
+    Подставляет аргументы сразу (они могут измениться, пока запись ждёт в очереди),
+    но оставляет ленивыми UserRef: слепой индекс, трассировки, JSON и запись в файл
+    считает поток QueueListener, а не цикл событий.
+    """
+
+    def prepare(self, record):
+        args = record.args
+        if not args:
+            return record
+        if not isinstance(args, tuple) or not any(isinstance(arg, UserRef) for arg in args):
+            record.msg, record.args = record.getMessage(), None
+            return record
+        users = tuple(arg for arg in args if isinstance(arg, UserRef))
+        slots = tuple(_UserSlot() if isinstance(arg, UserRef) else arg for arg in args)
+        # В тексте остаются только места для UserRef, прочие % экранируются
+        text = str(record.msg) % slots
+        record.msg = text.replace("%", "%%").replace(_UserSlot.MARK, "%s")
+        record.args = users
+        return record
+
+
+def setup_logging(level=LOG_LEVEL, levels=LOG_LEVELS, sample=LOG_SAMPLE, fmt=LOG_FORMAT,
+                  filename=LOG_FILE, queued=LOG_QUEUE):
+    output = logging.FileHandler(filename, encoding="utf-8") if filename else logging.StreamHandler()
+    if fmt == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = None
+    if queued:
+        handler = LoopQueueHandler(queue.SimpleQueue())
+        listener = QueueListener(handler.queue, output)
+        listener.start()
+        # Дописываем очередь при выходе
+        atexit.register(listener.stop)
+    else:
+        handler = output
+    handler.addFilter(SamplingFilter(_parse_settings(sample)))
+
+    # Форматы не используют поток, процесс и место вызова: не собираем их для каждой записи.
+    # Поиск вызывающего кадра публичной настройки не имеет: logging._srcfile = None
+    # опирается на внутренности CPython и при их изменении просто перестанет действовать
+    logging.logThreads = logging.logProcesses = logging.logMultiprocessing = False
+    logging._srcfile = None
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    for name, logger_level in _parse_settings(levels).items():
+        logging.getLogger(name).setLevel(logger_level.upper())
+    return listener
+
+
+log_listener = setup_logging()
+# Частые записи о каждом пересланном сообщении: их удобно прореживать через LOG_SAMPLE
+relay_log = logging.getLogger("bot.relay")
+
 # Добавляем импорты для шифрования и дешифрования
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad, unpad
@@ -30,116 +220,2174 @@ if not ENCRYPTION_KEY:
 # Преобразуем ключ в bytes. Убедитесь, что длина ключа корректна (16, 24 или 32 байта)
 ENCRYPTION_KEY = ENCRYPTION_KEY.encode()
 
-def encrypt_telegram_id(telegram_id: str) -> str:
+# Предыдущий ключ: нужен только на время ротации (см. rotate_encryption_key)
+ENCRYPTION_KEY_OLD = os.getenv("ENCRYPTION_KEY_OLD")
+ENCRYPTION_KEY_OLD = ENCRYPTION_KEY_OLD.encode() if ENCRYPTION_KEY_OLD else None
+
+# Ключ слепого индекса для поиска по Telegram ID. Не меняется при ротации ENCRYPTION_KEY
+BLIND_INDEX_KEY = os.getenv("BLIND_INDEX_KEY")
+if not BLIND_INDEX_KEY and ENCRYPTION_KEY_OLD:
+    # Иначе индекс считался бы новым ключом и не нашёл бы ни одного пользователя:
+    # каждый получил бы новую строку и новый топик, а rotate-key упал бы на уникальном индексе
+    logging.error("Во время ротации BLIND_INDEX_KEY обязателен: задайте его равным прежнему ENCRYPTION_KEY")
+    raise ValueError("BLIND_INDEX_KEY обязателен, если задан ENCRYPTION_KEY_OLD")
+if not BLIND_INDEX_KEY:
+    logging.warning("BLIND_INDEX_KEY не задан, используется ENCRYPTION_KEY. Задайте его до ротации ключа.")
+BLIND_INDEX_KEY = BLIND_INDEX_KEY.encode() if BLIND_INDEX_KEY else ENCRYPTION_KEY
+
+
+@functools.lru_cache(maxsize=4)
+def _ecb_cipher(key: bytes):
+    # ECB не хранит состояния между блоками, поэтому объект шифра можно переиспользовать
+    return AES.new(key, AES.MODE_ECB)
+
+
+@functools.lru_cache(maxsize=4)
+def _blind_index_hmac(key: bytes):
+    # Подготовленный HMAC: для каждого ID копируем его вместо повторной обработки ключа
+    return hmac.new(key, digestmod=hashlib.sha256)
+
+
+def encrypt_telegram_id(telegram_id: str, key: bytes = None) -> str:
     # Используем AES в режиме ECB для детерминированного шифрования
-    cipher = AES.new(ENCRYPTION_KEY, AES.MODE_ECB)
+    cipher = _ecb_cipher(key or ENCRYPTION_KEY)
     ct_bytes = cipher.encrypt(pad(telegram_id.encode(), AES.block_size))
     return base64.b64encode(ct_bytes).decode('utf-8')
 
-def decrypt_telegram_id(enc_telegram_id: str) -> str:
+def decrypt_telegram_id(enc_telegram_id: str, key: bytes = None) -> str:
     ct_bytes = base64.b64decode(enc_telegram_id)
-    cipher = AES.new(ENCRYPTION_KEY, AES.MODE_ECB)
-    pt = unpad(cipher.decrypt(ct_bytes), AES.block_size)
-    return pt.decode('utf-8')
+    if key is not None or not ENCRYPTION_KEY_OLD:
+        cipher = _ecb_cipher(key or ENCRYPTION_KEY)
+        pt = unpad(cipher.decrypt(ct_bytes), AES.block_size)
+        return pt.decode('utf-8')
+    # Во время ротации в таблице встречаются значения, зашифрованные обоими ключами
+    for candidate in (ENCRYPTION_KEY, ENCRYPTION_KEY_OLD):
+        try:
+            pt = unpad(_ecb_cipher(candidate).decrypt(ct_bytes), AES.block_size).decode('utf-8')
+        except ValueError:
+            continue
+        if pt.isdigit():
+            return pt
+    raise ValueError("Не удалось расшифровать Telegram ID ни одним из ключей")
+
+def decrypt_telegram_ids(enc_telegram_ids, key: bytes = None) -> list:
+    """
+    Расшифровывает пачку значений одним вызовом AES: в режиме ECB блоки независимы,
+    поэтому шифротексты можно склеить. На месте нерасшифрованных значений — None.
+    """
+    raw = [base64.b64decode(value) for value in enc_telegram_ids]
+    aligned = [ct if ct and len(ct) % AES.block_size == 0 else b"" for ct in raw]
+    plain = _ecb_cipher(key or ENCRYPTION_KEY).decrypt(b"".join(aligned))
+    result = []
+    offset = 0
+    for value, ct in zip(enc_telegram_ids, aligned):
+        chunk = plain[offset:offset + len(ct)]
+        offset += len(ct)
+        try:
+            telegram_id = unpad(chunk, AES.block_size).decode('utf-8') if ct else None
+        except ValueError:
+            telegram_id = None
+        if telegram_id is None or not telegram_id.isdigit():
+            telegram_id = None
+            # Во время ротации часть строк ещё зашифрована старым ключом
+            if key is None and ENCRYPTION_KEY_OLD:
+                with contextlib.suppress(ValueError):
+                    telegram_id = decrypt_telegram_id(value)
+        result.append(telegram_id)
+    return result
+
+def blind_index(telegram_id) -> bytes:
+    """HMAC-SHA256 от Telegram ID: детерминированный ключ для поиска по равенству."""
+    mac = _blind_index_hmac(BLIND_INDEX_KEY).copy()
+    mac.update(str(telegram_id).encode())
+    return mac.digest()
+
+
+class Metrics:
+    """
+    Минимальный реестр метрик в текстовом формате Prometheus:
+    счётчики, значения (gauge) и гистограммы с метками.
+    """
 
-db_lock = Lock()
-db_pool2 = None
-retry_queue = []
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # имя -> (тип, описание)
+        self._meta = {}
+        # имя -> {метки: значение}; для гистограмм значение — [счётчики корзин, сумма, количество]
+        self._values = {}
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def _series(self, name, kind):
+        if name not in self._meta:
+            self._meta[name] = (kind, "")
+        return self._values.setdefault(name, {})
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        series = self._series(name, "counter")
+        key = self._labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self._series(name, "gauge")[self._labels(labels)] = value
+
+    def observe(self, name, value, **labels):
+        series = self._series(name, "histogram")
+        key = self._labels(labels)
+        state = series.get(key)
+        if state is None:
+            state = series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def get(self, name, **labels):
+        return self._values.get(name, {}).get(self._labels(labels))
+
+    def total(self, name):
+        """Сумма счётчика по всем меткам (для гистограмм — число наблюдений)."""
+        values = self._values.get(name, {}).values()
+        return sum(value[2] if isinstance(value, list) else value for value in values)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def timed(self, name, **labels):
+        """Декоратор: время выполнения корутины попадает в гистограмму name."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (f'{key}="{Metrics._escape(value)}"' for key, value in pairs)
+        return "{" + ",".join(escaped) + "}"
+
+    @staticmethod
+    def _escape(value):
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text) in sorted(self._meta.items()):
+            series = self._values.get(name)
+            if not series:
+                continue
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series.items():
+                if kind != "histogram":
+                    lines.append(f"{name}{self._format_labels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_handler_duration_seconds", "histogram", "Время обработки сообщения обработчиком")
+metrics.describe("telegram_api_duration_seconds", "histogram", "Время запроса к Bot API по методам")
+metrics.describe("db_pool_acquire_seconds", "histogram", "Ожидание соединения из пула")
+metrics.describe("db_query_duration_seconds", "histogram", "Время выполнения запросов к базе")
+metrics.describe("bot_errors_total", "counter", "Ошибки по классам и месту возникновения")
+metrics.describe("identity_cache_requests", "counter", "Обращения к кэшу пользователей")
+metrics.describe("forum_group_users", "gauge", "Пользователи по группам с топиками")
+metrics.describe("topics_recreated_total", "counter", "Топики, пересозданные фоновой проверкой")
+metrics.describe("topics_dead", "gauge", "Удалённые топики, ожидающие пересоздания")
+metrics.describe("broadcast_messages_total", "counter", "Сообщения рассылки по результату")
+metrics.describe("bot_api_circuit_state", "gauge", "Состояние выключателя Bot API (1 — текущее)")
+metrics.describe("message_map_requests", "counter", "Поиск связей сообщений для правок и ответов")
+metrics.describe("db_pool_connections", "gauge", "Соединения пула по состоянию")
+metrics.describe("retry_queue_depth", "gauge", "Сообщения, ожидающие повторной отправки")
+UserIdentity = namedtuple("UserIdentity", ["row_id", "anon_id", "topic_id", "group_id"], defaults=(None,))
+
+
+def topic_key(group_id, topic_id):
+    """Ключ топика: номера топиков уникальны только внутри своей группы."""
+    return (int(group_id) if group_id is not None else None, topic_id)
+
+
+class IdentityCache:
+    """
+    Двусторонний кэш соответствий telegram_id ↔ anon_id ↔ (группа, topic_id).
+    Ограничен по количеству записей (LRU) и по времени жизни (TTL).
+    """
 
-async def process_retry_queue():
-    global retry_queue
-    while True:
-        # Копируем очередь для итерирования
-        for item in retry_queue.copy():
-            send_method = item.get('send_method')
-            kwargs = item.get('kwargs')
+    def __init__(self, max_size: int = 10000, ttl: float = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        # telegram_id -> (UserIdentity, время истечения)
+        self._entries = OrderedDict()
+        # Обратные индексы: (группа, topic_id) -> telegram_id и anon_id -> telegram_id
+        self._by_topic = {}
+        self._by_anon = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, telegram_id):
+        item = self._entries.get(telegram_id)
+        if item is None:
+            return None
+        identity, expires_at = item
+        if expires_at <= time.monotonic():
+            self._remove(telegram_id)
+            return None
+        self._entries.move_to_end(telegram_id)
+        return identity
+
+    def _remove(self, telegram_id):
+        item = self._entries.pop(telegram_id, None)
+        if item is None:
+            return
+        identity = item[0]
+        key = topic_key(identity.group_id, identity.topic_id)
+        if self._by_topic.get(key) == telegram_id:
+            del self._by_topic[key]
+        if self._by_anon.get(identity.anon_id) == telegram_id:
+            del self._by_anon[identity.anon_id]
+
+    def _count(self, value):
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def get(self, telegram_id):
+        """Возвращает UserIdentity по Telegram ID или None."""
+        return self._count(self._lookup(str(telegram_id)))
+
+    def get_by_topic(self, topic_id, group_id=None):
+        """Возвращает Telegram ID пользователя, которому принадлежит топик группы."""
+        telegram_id = self._by_topic.get(topic_key(group_id, topic_id))
+        if telegram_id is not None and self._lookup(telegram_id) is None:
+            telegram_id = None
+        return self._count(telegram_id)
+
+    def get_by_anon(self, anon_id):
+        """Возвращает Telegram ID пользователя по анонимному ID."""
+        telegram_id = self._by_anon.get(str(anon_id))
+        if telegram_id is not None and self._lookup(telegram_id) is None:
+            telegram_id = None
+        return self._count(telegram_id)
+
+    def put(self, telegram_id, row_id, anon_id, topic_id, group_id=None):
+        telegram_id = str(telegram_id)
+        self._remove(telegram_id)
+        identity = UserIdentity(row_id, str(anon_id), topic_id, group_id)
+        self._entries[telegram_id] = (identity, time.monotonic() + self.ttl)
+        self._by_topic[topic_key(group_id, topic_id)] = telegram_id
+        self._by_anon[identity.anon_id] = telegram_id
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+        return identity
+
+    def invalidate(self, telegram_id=None, topic_id=None, group_id=None):
+        """Удаляет запись по Telegram ID и/или по топику группы."""
+        if topic_id is not None:
+            owner = self._by_topic.get(topic_key(group_id, topic_id))
+            if owner is not None:
+                self._remove(owner)
+        if telegram_id is not None:
+            self._remove(str(telegram_id))
+
+    def clear(self):
+        self._entries.clear()
+        self._by_topic.clear()
+        self._by_anon.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+
+class GroupRouter:
+    """
+    Выбор группы с топиками для нового пользователя. Группа выбирается один раз
+    при регистрации и хранится рядом с topic_id, поэтому изменение списка групп
+    (добавление группы, вес 0 для заполненной) касается только новых пользователей.
+    hash — консистентное хеширование слепого индекса по кольцу с учётом весов:
+    все экземпляры бота выбирают одинаково, а новая группа забирает только свою долю.
+    least_loaded — группа с наименьшим числом пользователей на единицу веса.
+    """
+
+    def __init__(self, weights, strategy="hash", points=100):
+        self.weights = {int(group_id): weight for group_id, weight in weights.items()}
+        self.strategy = strategy
+        self.loads = dict.fromkeys(self.weights, 0)
+        ring = sorted(
+            (int.from_bytes(hashlib.sha256(f"{group_id}:{point}".encode()).digest()[:8], "big"), group_id)
+            for group_id, weight in self.weights.items()
+            for point in range(round(points * weight))
+        )
+        self._ring = [group_id for _, group_id in ring]
+        self._points = [point for point, _ in ring]
+
+    def assign(self, lookup_key: bytes):
+        """Группа для нового пользователя по его слепому индексу."""
+        if not self._ring:
+            raise ValueError("Нет групп, открытых для новых пользователей (GROUP_IDS).")
+        if self.strategy == "least_loaded":
+            return min(
+                (group_id for group_id, weight in self.weights.items() if weight > 0),
+                key=lambda group_id: (self.loads.get(group_id, 0) / self.weights[group_id], group_id),
+            )
+        point = int.from_bytes(lookup_key[:8], "big")
+        return self._ring[bisect.bisect(self._points, point) % len(self._ring)]
+
+    def record(self, group_id):
+        group_id = int(group_id)
+        self.loads[group_id] = self.loads.get(group_id, 0) + 1
+
+    async def refresh(self):
+        # Счётчики других экземпляров приходят только отсюда
+        async with db_acquire() as conn:
+            rows = await conn.fetch(f"SELECT group_id, COUNT(*) AS users FROM {TABLE_NAME} GROUP BY group_id")
+        self.loads = dict.fromkeys(self.weights, 0)
+        self.loads.update((row["group_id"], row["users"]) for row in rows)
+
+    async def run(self, interval):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error("Не удалось обновить число пользователей по группам: %s", e)
+            await asyncio.sleep(interval)
+
+
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "10000"))
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "3600"))
+
+# Параметры повторной отправки
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "2"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "300"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "10"))
+RETRY_CONCURRENCY = int(os.getenv("RETRY_CONCURRENCY", "5"))
+
+
+def retry_delay(attempt, retry_after=None, base=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    """
+    Задержка перед следующей попыткой: экспонента с jitter.
+    Если Telegram прислал retry_after, ждём не меньше указанного времени.
+    """
+    delay = min(max_delay, base * 2 ** attempt)
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if retry_after:
+        delay = retry_after + random.uniform(0, base)
+    return delay
+
+
+class RetryScheduler:
+    """
+    Очередь повторной отправки на куче по времени следующей попытки.
+    Фоновая задача просыпается ровно к ближайшему сроку, а не по таймеру.
+    """
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY, concurrency=RETRY_CONCURRENCY, dead_letter_size=1000):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.concurrency = concurrency
+        # Элементы кучи: (срок, порядковый номер, задание)
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        # Сообщения, исчерпавшие все попытки
+        self.dead_letters = deque(maxlen=dead_letter_size)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def oldest_age(self):
+        """Возраст самого старого сообщения в очереди, в секундах."""
+        if not self._heap:
+            return 0.0
+        return time.monotonic() - min(item["created_at"] for _, _, item in self._heap)
+
+    def schedule(self, send_method, kwargs, attempts=0, retry_after=None, created_at=None, link=None):
+        item = {
+            "send_method": send_method,
+            "kwargs": kwargs,
+            "attempts": attempts,
+            "created_at": created_at or time.monotonic(),
+            # Исходные сообщения: связь с копией запоминается после успешной отправки
+            "link": link,
+        }
+        delay = retry_delay(attempts, retry_after, self.base_delay, self.max_delay)
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), item))
+        self._wakeup.set()
+
+    async def _attempt(self, item, semaphore):
+        try:
+            if not redirect_to_live_topic(item["kwargs"]):
+                # Топик ещё пересоздаётся: попытка не тратится
+                self.schedule(item["send_method"], item["kwargs"], item["attempts"],
+                              retry_after=topic_reconciler.retry_delay, created_at=item["created_at"],
+                              link=item["link"])
+                return
+            sent = await item["send_method"](**item["kwargs"])
+            record_message_link(item["link"], sent)
+            logging.info("Сообщение успешно отправлено из очереди.")
+        except TelegramRetryAfter as e:
+            self.schedule(item["send_method"], item["kwargs"], item["attempts"],
+                          retry_after=e.retry_after, created_at=item["created_at"], link=item["link"])
+        except Exception as e:
+            error_message = str(e)
+            # Бот заблокирован или топик не принадлежит группе — удаляем сообщение из очереди.
+            # Удалённый топик пересоздаётся в фоне, и сообщение дождётся замены.
+            if "bot was blocked by the user" in error_message or (
+                topic_missing(error_message) and not topic_reconciler.mark_dead(
+                    item["kwargs"].get("chat_id"), item["kwargs"].get("message_thread_id")
+                )
+            ):
+                logging.info("Удаляем сообщение из очереди: %s", e)
+                return
+            attempts = item["attempts"] + 1
+            if attempts >= self.max_attempts:
+                self.dead_letters.append({**item, "attempts": attempts, "error": error_message})
+                logging.error("Сообщение не отправлено после %s попыток: %s", attempts, e)
+                return
+            logging.error("Не удалось отправить сообщение из очереди: %s", e)
+            self.schedule(item["send_method"], item["kwargs"], attempts,
+                          created_at=item["created_at"], link=item["link"])
+        finally:
+            semaphore.release()
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            timeout = self._heap[0][0] - time.monotonic()
+            if timeout > 0:
+                # Ждём ближайший срок или появление более раннего задания
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await semaphore.acquire()
+            _, _, item = heapq.heappop(self._heap)
+            asyncio.create_task(self._attempt(item, semaphore))
+
+
+
+def seal_user_ids(kwargs):
+    """
+    ID личных чатов в параметрах отправки заменяются шифротекстом: в outbox
+    Telegram ID хранятся так же, как в таблице пользователей. ID групп остаются открытыми.
+    """
+    sealed = dict(kwargs)
+    for field in ("chat_id", "from_chat_id"):
+        value = sealed.get(field)
+        if value is not None and str(value).isdigit():
+            sealed[f"{field}_encrypted"] = encrypt_telegram_id(str(sealed.pop(field)))
+    return sealed
+
+
+def open_user_ids(kwargs):
+    """Обратное к seal_user_ids: перед отправкой ID расшифровываются."""
+    for field in ("chat_id", "from_chat_id"):
+        value = kwargs.pop(f"{field}_encrypted", None)
+        if value is not None:
+            kwargs[field] = int(decrypt_telegram_id(value))
+    return kwargs
+
+
+def _json_default(value):
+    # Объекты aiogram (клавиатуры, InputMedia и т.п.) сохраняем как словари полей;
+    # значения по умолчанию бота (Default) подставятся заново при отправке
+    if isinstance(value, TelegramObject):
+        return {
+            key: item for key, item in value
+            if item is not None and not isinstance(item, Default)
+        }
+    raise TypeError(f"Объект {type(value).__name__} нельзя сохранить в outbox")
+
+
+class Outbox:
+    """
+    Очередь неотправленных сообщений в Postgres, переживающая перезапуски.
+    Записи пишутся пачками, а обработчики забирают готовые к отправке строки
+    через FOR UPDATE SKIP LOCKED, поэтому несколько процессов могут делить очередь.
+    ID пользователей хранятся зашифрованными, неотправленные сообщения удаляются
+    через dead_retention_days.
+    """
+
+    def __init__(self, table, batch_size=100, flush_interval=0.2, workers=2,
+                 claim_size=20, lease=60, poll_interval=5.0, max_attempts=RETRY_MAX_ATTEMPTS,
+                 dead_retention_days=7, maintenance_interval=3600):
+        self.table = table
+        self.dead_retention_days = dead_retention_days
+        self.maintenance_interval = maintenance_interval
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.workers = workers
+        self.claim_size = claim_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._buffer = []
+        self._flush_event = asyncio.Event()
+        self._work_event = asyncio.Event()
+
+    def enqueue(self, send_method, kwargs, retry_after=None, link=None):
+        """
+        Ставит сообщение в очередь на запись; сама запись происходит пачкой.
+        link (см. message_link) хранится в payload рядом с параметрами отправки.
+        """
+        if db_pool2 is None:
+            retry_scheduler.schedule(send_method, kwargs, retry_after=retry_after, link=link)
+            return
+        payload = seal_user_ids(kwargs)
+        if link:
+            payload["_link"] = link
+        self._buffer.append((
+            send_method.__name__,
+            json.dumps(payload, default=_json_default),
+            retry_delay(0, retry_after),
+        ))
+        if len(self._buffer) >= self.batch_size:
+            self._flush_event.set()
+
+    async def flush(self):
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+        try:
+            async with db_acquire() as conn:
+                await conn.executemany(
+                    f"INSERT INTO {self.table} (method, payload, due_at) "
+                    f"VALUES ($1, $2::jsonb, NOW() + $3::float8 * INTERVAL '1 second')",
+                    batch,
+                )
+        except Exception as e:
+            # База недоступна — не теряем сообщения, держим их в памяти процесса
+            logging.error("Не удалось записать %s сообщений в outbox: %s", len(batch), e)
+            for method, payload, delay in batch:
+                kwargs = open_user_ids(json.loads(payload))
+                link = kwargs.pop("_link", None)
+                retry_scheduler.schedule(getattr(bot, method), kwargs, link=link)
+            return
+        self._work_event.set()
+
+    async def run_writer(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+
+    async def claim(self):
+        """
+        Забирает пачку готовых строк и продлевает их срок на время аренды:
+        если процесс упадёт во время отправки, строки снова станут доступны.
+        Пока пачка отправляется, аренда продлевается (_extend_lease).
+        """
+        async with db_acquire() as conn:
+            return await conn.fetch(
+                f"""
+                UPDATE {self.table} SET due_at = NOW() + $2::float8 * INTERVAL '1 second',
+                                        attempts = attempts + 1,
+                                        claimed_by = $3
+                WHERE id IN (
+                    SELECT id FROM {self.table}
+                    WHERE NOT dead AND due_at <= NOW()
+                    ORDER BY due_at
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, method, payload, attempts
+                """,
+                self.claim_size, self.lease, INSTANCE_ID,
+            )
+
+    async def _deliver(self, row):
+        try:
+            kwargs = open_user_ids(json.loads(row["payload"]))
+            link = kwargs.pop("_link", None)
+        except Exception as e:
+            # Например, ID зашифрован ключом, которого уже нет: повтор не поможет
+            logging.error("Не удалось прочитать сообщение %s из outbox: %s", row["id"], e)
+            return "dead", row["id"], None, str(e)
+        try:
+            if not redirect_to_live_topic(kwargs):
+                # Топик ещё пересоздаётся: попытка не тратится
+                return "retry", row["id"], (topic_reconciler.retry_delay, row["attempts"] - 1), "topic is being recreated"
+            sent = await getattr(bot, row["method"])(**kwargs)
+            record_message_link(link, sent)
+            return "done", row["id"], None, None
+        except TelegramRetryAfter as e:
+            # Ограничение частоты не считается неудачной попыткой
+            return "retry", row["id"], (retry_delay(0, e.retry_after), row["attempts"] - 1), str(e)
+        except CircuitOpenError as e:
+            # Как и разомкнутый выключатель: попытка не тратится, строка ждёт пробного запроса
+            return "retry", row["id"], (e.retry_after, row["attempts"] - 1), str(e)
+        except Exception as e:
+            error_message = str(e)
+            if "bot was blocked by the user" in error_message or (
+                topic_missing(error_message)
+                and not topic_reconciler.mark_dead(kwargs.get("chat_id"), kwargs.get("message_thread_id"))
+            ):
+                logging.info("Удаляем сообщение из outbox: %s", e)
+                return "done", row["id"], None, error_message
+            if row["attempts"] >= self.max_attempts:
+                logging.error("Сообщение %s не отправлено после %s попыток: %s", row['id'], row['attempts'], e)
+                return "dead", row["id"], None, error_message
+            return "retry", row["id"], (retry_delay(row["attempts"]), row["attempts"]), error_message
+
+    async def _settle(self, results):
+        done, retry, dead = [], [], []
+        for status, row_id, schedule, error in results:
+            if status == "done":
+                done.append(row_id)
+            elif status == "retry":
+                delay, attempts = schedule
+                retry.append((row_id, delay, attempts, error))
+            else:
+                dead.append((row_id, error))
+        async with db_acquire() as conn:
+            if done:
+                await conn.execute(f"DELETE FROM {self.table} WHERE id = ANY($1::bigint[])", done)
+            if retry:
+                await conn.executemany(
+                    f"UPDATE {self.table} SET due_at = NOW() + $2::float8 * INTERVAL '1 second', "
+                    f"attempts = $3, last_error = $4 WHERE id = $1",
+                    retry,
+                )
+            if dead:
+                await conn.executemany(
+                    f"UPDATE {self.table} SET dead = TRUE, last_error = $2 WHERE id = $1", dead
+                )
+        if done:
+            logging.info("Из outbox отправлено сообщений: %s", len(done))
+
+    async def _wait_next(self):
+        # Спим до ближайшего срока, но не дольше poll_interval (строки могут добавлять другие процессы)
+        timeout = self.poll_interval
+        try:
+            async with db_acquire() as conn:
+                next_due = await conn.fetchval(
+                    f"SELECT EXTRACT(EPOCH FROM MIN(due_at) - NOW()) FROM {self.table} WHERE NOT dead"
+                )
+            if next_due is not None:
+                timeout = min(timeout, max(float(next_due), 0.05))
+        except Exception as e:
+            logging.error("Ошибка при чтении outbox: %s", e)
+        try:
+            await asyncio.wait_for(self._work_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._work_event.clear()
+
+    async def _extend_lease(self, in_flight):
+        """
+        Продлевает аренду строк, которые ещё отправляются: ожидание в ограничителе
+        частоты (20 сообщений в минуту на группу) бывает дольше lease, и без продления
+        строки забрал бы другой обработчик и отправил второй раз.
+        """
+        while in_flight:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                async with db_acquire() as conn:
+                    await conn.execute(
+                        f"UPDATE {self.table} SET due_at = NOW() + $2::float8 * INTERVAL '1 second' "
+                        f"WHERE id = ANY($1::bigint[]) AND claimed_by = $3",
+                        list(in_flight), self.lease, INSTANCE_ID,
+                    )
+            except Exception as e:
+                logging.error("Не удалось продлить аренду строк outbox: %s", e)
+
+    async def _process(self, row, in_flight):
+        # Строка закрывается сразу после отправки, не дожидаясь остальных из пачки
+        try:
+            await self._settle([await self._deliver(row)])
+        except Exception as e:
+            logging.error("Ошибка обработки строки outbox %s: %s", row["id"], e)
+        finally:
+            in_flight.discard(row["id"])
+
+    async def run_worker(self):
+        while True:
+            try:
+                rows = await self.claim()
+                if rows:
+                    in_flight = {row["id"] for row in rows}
+                    heartbeat = asyncio.create_task(self._extend_lease(in_flight))
+                    try:
+                        await asyncio.gather(*(self._process(row, in_flight) for row in rows))
+                    finally:
+                        heartbeat.cancel()
+                    continue
+            except Exception as e:
+                logging.error("Ошибка обработки outbox: %s", e)
+            await self._wait_next()
+
+    async def stats(self):
+        async with db_acquire() as conn:
+            row = await conn.fetchrow(f"""
+                SELECT COUNT(*) FILTER (WHERE NOT dead) AS pending,
+                       COUNT(*) FILTER (WHERE dead) AS dead,
+                       COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(created_at) FILTER (WHERE NOT dead)), 0)
+                           AS oldest_age
+                FROM {self.table}
+            """)
+        return {
+            "pending": row["pending"],
+            "dead": row["dead"],
+            "oldest_age": float(row["oldest_age"]),
+            "buffered": len(self._buffer),
+        }
+
+    async def purge_dead(self):
+        """Удаляет неотправленные сообщения старше dead_retention_days: их текст и получатель не хранятся вечно."""
+        async with db_acquire() as conn:
+            deleted = await conn.fetchval(
+                f"WITH deleted AS (DELETE FROM {self.table} "
+                f"WHERE dead AND created_at < NOW() - $1::float8 * INTERVAL '1 day' RETURNING 1) "
+                f"SELECT COUNT(*) FROM deleted",
+                self.dead_retention_days,
+            )
+        if deleted:
+            logging.info("Из outbox удалено неотправленных сообщений: %s", deleted)
+
+    async def run_maintenance(self):
+        while True:
+            try:
+                await self.purge_dead()
+            except Exception as e:
+                logging.error("Ошибка очистки outbox: %s", e)
+            await asyncio.sleep(self.maintenance_interval)
+
+    def start(self):
+        asyncio.create_task(self.run_writer())
+        asyncio.create_task(self.run_maintenance())
+        for _ in range(self.workers):
+            asyncio.create_task(self.run_worker())
+
+
+
+# Связи сообщений топика и чата пользователя
+MESSAGE_MAP_CACHE_SIZE = int(os.getenv("MESSAGE_MAP_CACHE_SIZE", "50000"))
+MESSAGE_MAP_RETENTION_DAYS = int(os.getenv("MESSAGE_MAP_RETENTION_DAYS", "30"))
+
+
+class MessageMap:
+    """
+    Соответствие сообщения в топике группы и его копии в чате пользователя
+    (в обе стороны) — для правок и ответов. Свежие связи хранятся в LRU в памяти,
+    в Postgres они пишутся пачками. Таблица разбита на партиции по дням,
+    устаревшие партиции удаляются целиком, без DELETE по строкам.
+    """
+
+    def __init__(self, table, max_size=MESSAGE_MAP_CACHE_SIZE, retention_days=MESSAGE_MAP_RETENTION_DAYS,
+                 batch_size=200, flush_interval=0.5, maintenance_interval=3600, days_ahead=2):
+        self.table = table
+        self.max_size = max_size
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.maintenance_interval = maintenance_interval
+        self.days_ahead = days_ahead
+        # (group_chat_id, group_message_id) -> (user_row_id, user_message_id) и обратно
+        self._by_group = OrderedDict()
+        self._by_user = OrderedDict()
+        self._buffer = []
+        self._flush_event = asyncio.Event()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._by_group)
+
+    def _remember(self, group_key, user_key):
+        for index, key, value in ((self._by_group, group_key, user_key), (self._by_user, user_key, group_key)):
+            index[key] = value
+            index.move_to_end(key)
+            while len(index) > self.max_size:
+                index.popitem(last=False)
+
+    def add(self, user_row_id, user_message_id, group_chat_id, group_message_id):
+        """Запоминает связь; в базу она попадёт со следующей пачкой."""
+        group_key = (int(group_chat_id), group_message_id)
+        user_key = (user_row_id, user_message_id)
+        self._remember(group_key, user_key)
+        if db_pool2 is None:
+            return
+        self._buffer.append((*user_key, *group_key))
+        if len(self._buffer) >= self.batch_size:
+            self._flush_event.set()
+
+    async def _lookup(self, index, key, columns, where):
+        value = index.get(key)
+        if value is not None:
+            index.move_to_end(key)
+            self.hits += 1
+            return value
+        self.misses += 1
+        if db_pool2 is None:
+            return None
+        async with db_acquire() as conn:
+            row = await conn.fetchrow(
+                f"SELECT {columns} FROM {self.table} WHERE {where} ORDER BY created_at DESC LIMIT 1", *key
+            )
+        if row is None:
+            return None
+        value = tuple(row.values())
+        if index is self._by_group:
+            self._remember(key, value)
+        else:
+            self._remember(value, key)
+        return value
+
+    async def by_group(self, group_chat_id, group_message_id):
+        """(user_row_id, user_message_id) для сообщения в топике или None."""
+        return await self._lookup(
+            self._by_group, (int(group_chat_id), group_message_id),
+            "user_row_id, user_message_id", "group_chat_id = $1 AND group_message_id = $2",
+        )
+
+    async def by_user(self, user_row_id, user_message_id):
+        """(group_chat_id, group_message_id) для сообщения в чате пользователя или None."""
+        return await self._lookup(
+            self._by_user, (user_row_id, user_message_id),
+            "group_chat_id, group_message_id", "user_row_id = $1 AND user_message_id = $2",
+        )
+
+    async def flush(self):
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+        try:
+            async with db_acquire() as conn:
+                await conn.executemany(
+                    f"INSERT INTO {self.table} (user_row_id, user_message_id, group_chat_id, group_message_id) "
+                    f"VALUES ($1, $2, $3, $4)",
+                    batch,
+                )
+        except Exception as e:
+            # Связи не критичны: без них правка уйдёт новым сообщением
+            logging.error("Не удалось записать %s связей сообщений: %s", len(batch), e)
+
+    async def run_writer(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+
+    def _partition(self, day):
+        return f"{self.table}_p{day:%Y%m%d}"
+
+    async def maintain(self):
+        """
+        Создаёт партиции на ближайшие дни и удаляет старше retention_days.
+        Проход выполняет один экземпляр, остальные его пропускают.
+        """
+        today = datetime.now(timezone.utc).date()
+        cutoff = f"{today - timedelta(days=self.retention_days):%Y%m%d}"
+        async with db_acquire() as conn:
+            async with conn.transaction():
+                if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1, 0)", LOCK_MESSAGE_MAP):
+                    return
+                for offset in range(self.days_ahead + 1):
+                    day = today + timedelta(days=offset)
+                    await conn.execute(
+                        f"CREATE TABLE IF NOT EXISTS {self._partition(day)} PARTITION OF {self.table} "
+                        f"FOR VALUES FROM ('{day} 00:00+00') TO ('{day + timedelta(days=1)} 00:00+00')"
+                    )
+                partitions = await conn.fetch(
+                    "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                    "WHERE i.inhparent = $1::regclass",
+                    self.table,
+                )
+                for row in partitions:
+                    if row["relname"].rsplit("_p", 1)[-1] < cutoff:
+                        await conn.execute(f"DROP TABLE IF EXISTS {row['relname']}")
+                        logging.info("Удалена устаревшая партиция %s", row['relname'])
+
+    async def run_maintenance(self):
+        while True:
+            await asyncio.sleep(self.maintenance_interval)
+            try:
+                await self.maintain()
+            except Exception as e:
+                logging.error("Ошибка обслуживания партиций %s: %s", self.table, e)
+
+    def stats(self):
+        return {
+            "size": len(self._by_group),
+            "hits": self.hits,
+            "misses": self.misses,
+            "buffered": len(self._buffer),
+        }
+
+    def start(self):
+        asyncio.create_task(self.run_writer())
+        asyncio.create_task(self.run_maintenance())
+
+
+# Ограничения Telegram на исходящие сообщения
+RATE_LIMIT_GLOBAL = float(os.getenv("RATE_LIMIT_GLOBAL", "30"))
+RATE_LIMIT_CHAT = float(os.getenv("RATE_LIMIT_CHAT", "1"))
+RATE_LIMIT_GROUP_PER_MINUTE = float(os.getenv("RATE_LIMIT_GROUP_PER_MINUTE", "20"))
+
+
+class TokenBucket:
+    """
+    Корзина токенов с резервированием: каждый вызов сразу занимает токен
+    и получает время, которое нужно подождать. Ожидающие обслуживаются по очереди.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def reserve(self, tokens=1):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= tokens
+        return max(0.0, -self._tokens / self.rate)
+
+
+class SendRateLimiter(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: пропускает send*/copy*/forward* вызовы через общую
+    корзину, корзину получателя и отдельную корзину для группы с топиками.
+    Вместо ошибок 429 сообщения встают в очередь.
+    """
+
+    def __init__(self, global_rate=RATE_LIMIT_GLOBAL, chat_rate=RATE_LIMIT_CHAT,
+                 group_rate_per_minute=RATE_LIMIT_GROUP_PER_MINUTE, group_ids=(), max_chats=10000):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.group_buckets = {
+            str(group_id): TokenBucket(group_rate_per_minute / 60, group_rate_per_minute)
+            for group_id in group_ids if group_id
+        }
+        self.max_chats = max_chats
+        self._chat_buckets = OrderedDict()
+        self.waiting = 0
+        self.sent = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @staticmethod
+    def is_limited(method):
+        name = method.__api_method__
+        return name != "sendChatAction" and name.startswith(("send", "copy", "forward"))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.group_buckets.get(chat_id)
+        if bucket is not None:
+            return bucket
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Давно неиспользуемые корзины полны, поэтому их можно безопасно выбросить
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+            while len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not self.is_limited(method):
+            return await make_request(bot, method)
+
+        # Альбом расходует по токену на каждый элемент
+        tokens = len(getattr(method, "media", None) or ()) or 1
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            delay = self._chat_bucket(str(chat_id)).reserve(tokens)
+            if delay:
+                await asyncio.sleep(delay)
+            delay = self.global_bucket.reserve(tokens)
+            if delay:
+                await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - started
+        self.sent += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return await make_request(bot, method)
+
+    def stats(self):
+        return {
+            "waiting": self.waiting,
+            "sent": self.sent,
+            "avg_wait": self.total_wait / self.sent if self.sent else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки запросов к Bot API по методам (без ожидания в ограничителе)."""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.monotonic()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("bot_errors_total", error=type(e).__name__, source=name)
+            raise
+        finally:
+            metrics.observe("telegram_api_duration_seconds", time.monotonic() - started, method=name)
+
+
+# Автоматический выключатель Bot API
+CIRCUIT_WINDOW = float(os.getenv("CIRCUIT_WINDOW", "30"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "10"))
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+# Без объявленного сбоя одиночные ошибки напоминают пользователю о сети не чаще раза в интервал
+NETWORK_NOTICE_INTERVAL = float(os.getenv("NETWORK_NOTICE_INTERVAL", "3600"))
+
+
+class CircuitOpenError(Exception):
+    """Запрос не отправлен: выключатель Bot API разомкнут."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Bot API недоступен, повтор через {retry_after:.0f} с")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Выключатель для Bot API. closed — запросы идут как обычно, а их исходы
+    копятся в скользящем окне; если доля сетевых и серверных ошибок в окне
+    превышает порог, выключатель размыкается (open) и запросы сразу получают
+    CircuitOpenError без сетевых вызовов. Через open_seconds пропускается
+    пробный запрос (half_open): успех замыкает выключатель, ошибка снова размыкает.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, window=CIRCUIT_WINDOW, min_calls=CIRCUIT_MIN_CALLS, failure_rate=CIRCUIT_FAILURE_RATE,
+                 open_seconds=CIRCUIT_OPEN_SECONDS, notice_interval=NETWORK_NOTICE_INTERVAL, max_chats=10000):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.notice_interval = notice_interval
+        self.max_chats = max_chats
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        # Номер периода без сбоя; меняется, когда выключатель снова замыкается
+        self.generation = 0
+        self.rejected = 0
+        self._outcomes = deque()
+        self._failures = 0
+        self._probe = False
+        self._notified = OrderedDict()
+
+    @staticmethod
+    def is_failure(error):
+        # Ответы вроде 400/403/429 означают, что API работает
+        return isinstance(error, (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError))
+
+    def _transition(self, state):
+        logging.warning("Выключатель Bot API: %s -> %s", self.state, state)
+        metrics.inc("bot_api_circuit_transitions_total", state=state)
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+        elif state == self.CLOSED:
+            self.generation += 1
+            self._outcomes.clear()
+            self._failures = 0
+        self.state = state
+
+    def retry_in(self):
+        return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+
+    def before_request(self):
+        """Бросает CircuitOpenError, если запрос сейчас отправлять нельзя."""
+        if self.state == self.OPEN and self.retry_in() == 0:
+            self._transition(self.HALF_OPEN)
+        if self.state == self.CLOSED:
+            return False
+        if self.state == self.HALF_OPEN and not self._probe:
+            self._probe = True
+            return True
+        self.rejected += 1
+        # В half_open ответ на пробный запрос ожидается скоро
+        raise CircuitOpenError(self.retry_in() or 1.0)
+
+    def fail_fast(self):
+        """
+        Дешёвая проверка до ограничителя частоты: пока выключатель разомкнут или
+        пробный запрос уже занят, запрос отклоняется сразу. Сам пробный запрос
+        выбирает before_request — уже после ожидания в ограничителе, иначе
+        half_open длился бы всё время этого ожидания.
+        """
+        if self.state == self.OPEN and self.retry_in() > 0 or self.state == self.HALF_OPEN and self._probe:
+            self.rejected += 1
+            raise CircuitOpenError(self.retry_in() or 1.0)
+
+    def record(self, failed, probe=False):
+        if failed is None:
+            # Отменённый запрос ничего не говорит о состоянии API
+            self._probe = self._probe and not probe
+            return
+        if probe:
+            self._probe = False
+            self._transition(self.OPEN if failed else self.CLOSED)
+            return
+        if self.state != self.CLOSED:
+            return
+        now = time.monotonic()
+        self._outcomes.append((now, failed))
+        self._failures += failed
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._failures -= self._outcomes.popleft()[1]
+        if len(self._outcomes) >= self.min_calls and self._failures / len(self._outcomes) >= self.failure_rate:
+            self._transition(self.OPEN)
+
+    def should_notify(self, chat_id):
+        """Предупреждать ли чат о проблемах с сетью: не больше раза за сбой."""
+        chat_id = str(chat_id)
+        now = time.monotonic()
+        notified = self._notified.get(chat_id)
+        if notified is not None and notified[0] == self.generation and now - notified[1] < self.notice_interval:
+            return False
+        self._notified[chat_id] = (self.generation, now)
+        self._notified.move_to_end(chat_id)
+        while len(self._notified) > self.max_chats:
+            self._notified.popitem(last=False)
+        return True
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "calls": len(self._outcomes),
+            "failures": self._failures,
+            "rejected": self.rejected,
+            "retry_in": self.retry_in() if self.state != self.CLOSED else 0.0,
+        }
+
+
+class CircuitGateMiddleware(BaseRequestMiddleware):
+    """Отклоняет запросы при разомкнутом выключателе, не ставя их в очередь ограничителя частоты."""
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+
+    async def __call__(self, make_request, bot, method):
+        if method.__api_method__ != "getUpdates":
+            self.breaker.fail_fast()
+        return await make_request(bot, method)
+
+
+class CircuitBreakerMiddleware(BaseRequestMiddleware):
+    """
+    Пропускает запросы к Bot API через выключатель (кроме long polling getUpdates).
+    Стоит после ограничителя частоты: пробный запрос уходит сразу, как только занят.
+    """
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+
+    async def __call__(self, make_request, bot, method):
+        if method.__api_method__ == "getUpdates":
+            return await make_request(bot, method)
+        probe = self.breaker.before_request()
+        try:
+            result = await make_request(bot, method)
+        except asyncio.CancelledError:
+            self.breaker.record(None, probe)
+            raise
+        except Exception as e:
+            self.breaker.record(self.breaker.is_failure(e), probe)
+            raise
+        self.breaker.record(False, probe)
+        return result
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы и ошибки обработчиков диспетчера."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            metrics.inc("bot_errors_total", error=type(e).__name__, source=name)
+            raise
+        finally:
+            metrics.observe("bot_handler_duration_seconds", time.monotonic() - started, handler=name)
+
+
+class KeyedScheduler:
+    """
+    Очередь задач на каждый ключ (разговор): внутри ключа задачи выполняются
+    строго по порядку, разные ключи обрабатываются параллельно.
+    Обработчик ключа существует, только пока в его очереди есть задачи.
+    """
+
+    def __init__(self):
+        self._queues = {}
+
+    def __len__(self):
+        return len(self._queues)
+
+    def submit(self, key, factory):
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            queue.append((factory, future))
+            asyncio.create_task(self._drain(key, queue))
+        else:
+            queue.append((factory, future))
+        return future
+
+    async def _drain(self, key, queue):
+        try:
+            while queue:
+                factory, future = queue.popleft()
+                if future.cancelled():
+                    continue
+                try:
+                    result = await factory()
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            # Очередь опустела — освобождаем ключ
+            del self._queues[key]
+
+
+def message_conversation_key(message: types.Message):
+    """Ключ разговора: пользователь в личке или топик в группе."""
+    if message.chat.type == "private":
+        return "user", message.chat.id
+    return "topic", message.chat.id, message.message_thread_id
+
+
+def conversation_key(update: types.Update):
+    message = update.message or update.edited_message
+    if message is None:
+        return None
+    return message_conversation_key(message)
+
+
+class OrderedUpdateMiddleware(BaseMiddleware):
+    """Пропускает обновления одного разговора через общую очередь по порядку."""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, handler, event, data):
+        key = conversation_key(event)
+        if key is None:
+            return await handler(event, data)
+        return await self.scheduler.submit(key, lambda: handler(event, data))
+
+
+
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "0.6"))
+
+
+class MediaGroupBuffer:
+    """
+    Собирает сообщения одного альбома (общий media_group_id) в течение короткого
+    окна и передаёт их обработчику одной пачкой. Отправка альбома ставится
+    в очередь его разговора, поэтому порядок с соседними сообщениями сохраняется.
+    """
+
+    def __init__(self, scheduler, window=MEDIA_GROUP_WINDOW):
+        self.scheduler = scheduler
+        self.window = window
+        # media_group_id -> {"key", "handler", "messages", "timer"}
+        self._groups = {}
+
+    def __len__(self):
+        return len(self._groups)
+
+    def add(self, message: types.Message, handler):
+        group_id = message.media_group_id
+        group = self._groups.get(group_id)
+        if group is None:
+            group = self._groups[group_id] = {
+                "key": message_conversation_key(message),
+                "handler": handler,
+                "messages": [],
+                "timer": None,
+            }
+        else:
+            group["timer"].cancel()
+        group["messages"].append(message)
+        # Каждое новое сообщение альбома продлевает окно ожидания
+        group["timer"] = asyncio.get_running_loop().call_later(
+            self.window, self._schedule_flush, group_id
+        )
+
+    def _schedule_flush(self, group_id):
+        group = self._groups.get(group_id)
+        if group is not None:
+            self.scheduler.submit(group["key"], lambda: self.flush(group_id))
+
+    async def flush(self, group_id):
+        group = self._groups.pop(group_id, None)
+        if group is None:
+            return
+        group["timer"].cancel()
+        messages = sorted(group["messages"], key=lambda m: m.message_id)
+        try:
+            await group["handler"](messages)
+        except Exception as e:
+            logging.error("Ошибка при отправке альбома %s: %s", group_id, e)
+
+    async def flush_key(self, key):
+        """Отправляет незавершённые альбомы разговора до следующего сообщения."""
+        for group_id in [g for g, group in self._groups.items() if group["key"] == key]:
+            await self.flush(group_id)
+
+
+# Типы сообщений, которые пересылаются через copy_message (служебные игнорируются)
+RELAYED_CONTENT_TYPES = {
+    ContentType.TEXT, ContentType.PHOTO, ContentType.VIDEO, ContentType.DOCUMENT,
+    ContentType.AUDIO, ContentType.VOICE, ContentType.ANIMATION, ContentType.STICKER,
+    ContentType.VIDEO_NOTE, ContentType.LOCATION, ContentType.VENUE, ContentType.CONTACT,
+    ContentType.DICE,
+}
+# Типы, у которых есть подпись
+CAPTIONED_CONTENT_TYPES = {
+    ContentType.PHOTO, ContentType.VIDEO, ContentType.DOCUMENT,
+    ContentType.AUDIO, ContentType.VOICE, ContentType.ANIMATION,
+}
+
+
+def album_media(messages, first_caption=None):
+    """Собирает InputMedia для send_media_group из сообщений альбома."""
+    media = []
+    for index, message in enumerate(messages):
+        caption = first_caption if index == 0 and first_caption is not None else message.caption
+        if message.photo:
+            media.append(InputMediaPhoto(media=message.photo[-1].file_id, caption=caption))
+        elif message.video:
+            media.append(InputMediaVideo(media=message.video.file_id, caption=caption))
+        elif message.document:
+            media.append(InputMediaDocument(media=message.document.file_id, caption=caption))
+        elif message.audio:
+            media.append(InputMediaAudio(media=message.audio.file_id, caption=caption))
+    return media
+
+
+# Идентификатор экземпляра бота (для нескольких процессов на одной базе)
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+# Пространства имён advisory-блокировок Postgres
+LOCK_TOPIC = 2  # проверка топиков (ключ 0)
+LOCK_MESSAGE_MAP = 3
+
+
+class ClusterEvents:
+    """
+    Уведомления между экземплярами бота через LISTEN/NOTIFY.
+    Когда у пользователя меняется topic_id, остальные экземпляры сбрасывают кэш.
+    """
+
+    def __init__(self, instance_id, reconnect_delay=5.0, keepalive=30.0):
+        self.instance_id = instance_id
+        self.channel = None
+        self.reconnect_delay = reconnect_delay
+        self.keepalive = keepalive
+        self._connected_before = False
+
+    async def publish(self, conn, event, **data):
+        if self.channel is None:
+            return
+        payload = json.dumps({"instance": self.instance_id, "event": event, **data})
+        await conn.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+
+    def _on_notification(self, conn, pid, channel, payload):
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            logging.error("Некорректное уведомление в канале %s: %s", channel, payload)
+            return
+        if data.get("instance") == self.instance_id:
+            return
+        if data.get("event") == "topics_changed":
+            topic_reconciler.apply(data["topics"])
+
+    async def run(self, database_url, channel):
+        self.channel = channel
+        while True:
+            conn = None
             try:
-                await send_method(**kwargs)
-                retry_queue.remove(item)
-                logging.info("Сообщение успешно отправлено из очереди.")
+                conn = await asyncpg.connect(database_url)
+                closed = asyncio.Event()
+                conn.add_termination_listener(lambda _: closed.set())
+                await conn.add_listener(channel, self._on_notification)
+                if self._connected_before:
+                    # Пока соединения не было, уведомления могли потеряться
+                    identity_cache.clear()
+                self._connected_before = True
+                logging.info("Подписка на канал %s установлена", channel)
+                while not closed.is_set():
+                    try:
+                        await asyncio.wait_for(closed.wait(), self.keepalive)
+                    except asyncio.TimeoutError:
+                        # Проверяем, что соединение живо
+                        await conn.execute("SELECT 1")
             except Exception as e:
-                # Если ошибка говорит о том, что тред не найден - удаляем сообщение из очереди
-                if "message thread not found" in str(e):
-                    retry_queue.remove(item)
-                    logging.info(f"Удаляем сообщение из очереди, т.к. не найден тред: {e}")
+                logging.error("Потеряна подписка на канал %s: %s", channel, e)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(self.reconnect_delay)
+
+
+# Рассылка всем пользователям
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "10"))
+# Ниже общего RATE_LIMIT_GLOBAL, чтобы ответы в топиках не ждали рассылку
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))
+BROADCAST_STATUSES = {"running": "идёт", "done": "завершена", "cancelled": "остановлена"}
+
+
+class Broadcaster:
+    """
+    Рассылка сообщения всем зарегистрированным пользователям.
+    Получатели читаются пачками по возрастанию id, после каждой пачки прогресс
+    и счётчики сохраняются в таблице рассылок, поэтому прерванная рассылка
+    продолжается с места остановки (в худшем случае повторится одна пачка).
+    Рассылку выполняет экземпляр, который её захватил; пока идёт пачка, он
+    продлевает аренду каждые lease / 3 секунд. Если строку не обновляли дольше
+    lease секунд, рассылку подхватывает другой экземпляр, а прежний, заметив
+    потерю аренды, прекращает отправку пачки.
+    """
+
+    def __init__(self, table, workers=BROADCAST_WORKERS, rate=BROADCAST_RATE,
+                 batch_size=BROADCAST_BATCH_SIZE, lease=300, max_retries=3):
+        self.table = table
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_retries = max_retries
+        self._running = set()
+
+    async def create(self, created_by, report_chat_id, report_thread_id=None, source_chat_id=None,
+                     source_message_id=None, text=None):
+        async with db_acquire() as conn:
+            return await conn.fetchval(
+                f"INSERT INTO {self.table} "
+                f"(created_by, report_chat_id, report_thread_id, source_chat_id, source_message_id, text) "
+                f"VALUES ($1, $2, $3, $4, $5, $6) RETURNING id",
+                created_by, report_chat_id, report_thread_id, source_chat_id, source_message_id, text,
+            )
+
+    async def claim(self, broadcast_id):
+        async with db_acquire() as conn:
+            return await conn.fetchrow(
+                f"""
+                UPDATE {self.table} SET claimed_by = $2, updated_at = NOW()
+                WHERE id = $1 AND status = 'running'
+                  AND (claimed_by IS NULL OR claimed_by = $2
+                       OR updated_at < NOW() - $3::float8 * INTERVAL '1 second')
+                RETURNING *
+                """,
+                broadcast_id, INSTANCE_ID, self.lease,
+            )
+
+    async def recipients(self, after_id):
+        """
+        Пачки (id строки, Telegram ID) с id больше after_id. Каждая пачка читается
+        серверным курсором в короткой транзакции: соединение не занято, пока идёт отправка.
+        """
+        while True:
+            async with db_acquire() as conn:
+                async with conn.transaction(readonly=True):
+                    rows = [row async for row in conn.cursor(
+                        f"SELECT id, telegram_id FROM {TABLE_NAME} WHERE id > $1 ORDER BY id LIMIT $2",
+                        after_id, self.batch_size, prefetch=self.batch_size,
+                    )]
+            if not rows:
+                return
+            telegram_ids = decrypt_telegram_ids([row["telegram_id"] for row in rows])
+            yield [(row["id"], telegram_id) for row, telegram_id in zip(rows, telegram_ids)]
+            after_id = rows[-1]["id"]
+
+    async def _send(self, broadcast, telegram_id):
+        if telegram_id is None:
+            return "failed"
+        attempt = 0
+        while attempt <= self.max_retries:
+            await asyncio.sleep(self.bucket.reserve())
+            try:
+                if broadcast["source_message_id"]:
+                    await bot.copy_message(
+                        chat_id=telegram_id,
+                        from_chat_id=broadcast["source_chat_id"],
+                        message_id=broadcast["source_message_id"],
+                    )
                 else:
-                    logging.error(f"Не удалось отправить сообщение из очереди: {e}")
-        await asyncio.sleep(10)
+                    await bot.send_message(chat_id=telegram_id, text=broadcast["text"])
+                return "delivered"
+            except TelegramForbiddenError:
+                return "blocked"
+            except (TelegramRetryAfter, CircuitOpenError) as e:
+                # Ожидание лимита или восстановления API попыткой не считается
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logging.error("Рассылка %s: не удалось отправить сообщение: %s", broadcast['id'], e)
+                    return "failed"
+                await asyncio.sleep(retry_delay(attempt, max_delay=30))
+                attempt += 1
+        return "failed"
+
+    async def _checkpoint(self, broadcast_id, last_user_id, counts):
+        # Условие по владельцу и статусу: остановленную или перехваченную рассылку прекращаем
+        async with db_acquire() as conn:
+            return await conn.fetchval(
+                f"""
+                UPDATE {self.table}
+                SET last_user_id = $2, delivered = delivered + $3, blocked = blocked + $4,
+                    failed = failed + $5, updated_at = NOW()
+                WHERE id = $1 AND status = 'running' AND claimed_by = $6
+                RETURNING id
+                """,
+                broadcast_id, last_user_id, counts["delivered"], counts["blocked"], counts["failed"],
+                INSTANCE_ID,
+            )
 
-async def safe_send(send_method, **kwargs):
+    async def _heartbeat(self, broadcast_id, sending):
+        # Продлевает аренду во время отправки пачки; остановленная или перехваченная
+        # рассылка отменяет отправку, чтобы пачку не слали два экземпляра сразу
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                async with db_acquire() as conn:
+                    alive = await conn.fetchval(
+                        f"UPDATE {self.table} SET updated_at = NOW() "
+                        f"WHERE id = $1 AND status = 'running' AND claimed_by = $2 RETURNING id",
+                        broadcast_id, INSTANCE_ID,
+                    )
+            except Exception as e:
+                logging.error("Рассылка %s: не удалось продлить аренду: %s", broadcast_id, e)
+                continue
+            if not alive:
+                sending.cancel()
+                return
+
+    async def run(self, broadcast_id):
+        if broadcast_id in self._running:
+            return
+        broadcast = await self.claim(broadcast_id)
+        if broadcast is None:
+            return
+        self._running.add(broadcast_id)
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def send(telegram_id):
+            async with semaphore:
+                return await self._send(broadcast, telegram_id)
+
+        try:
+            logging.info("Рассылка %s начата с пользователя %s", broadcast_id, broadcast['last_user_id'] + 1)
+            async for batch in self.recipients(broadcast["last_user_id"]):
+                sending = asyncio.gather(*(send(telegram_id) for _, telegram_id in batch))
+                heartbeat = asyncio.create_task(self._heartbeat(broadcast_id, sending))
+                try:
+                    results = await sending
+                except asyncio.CancelledError:
+                    if not heartbeat.done():
+                        raise
+                    logging.info("Рассылка %s остановлена или перехвачена во время пачки", broadcast_id)
+                    return
+                finally:
+                    heartbeat.cancel()
+                counts = {"delivered": 0, "blocked": 0, "failed": 0}
+                for result in results:
+                    counts[result] += 1
+                    metrics.inc("broadcast_messages_total", result=result)
+                if not await self._checkpoint(broadcast_id, batch[-1][0], counts):
+                    logging.info("Рассылка %s остановлена", broadcast_id)
+                    return
+            async with db_acquire() as conn:
+                broadcast = await conn.fetchrow(
+                    f"UPDATE {self.table} SET status = 'done', finished_at = NOW(), updated_at = NOW() "
+                    f"WHERE id = $1 AND claimed_by = $2 RETURNING *",
+                    broadcast_id, INSTANCE_ID,
+                )
+            if broadcast is not None:
+                await self.report(broadcast)
+        finally:
+            self._running.discard(broadcast_id)
+
+    async def report(self, broadcast):
+        text = (
+            f"Рассылка #{broadcast['id']}: {BROADCAST_STATUSES.get(broadcast['status'], broadcast['status'])}. "
+            f"Доставлено: {broadcast['delivered']}, заблокировали бота: {broadcast['blocked']}, "
+            f"ошибок: {broadcast['failed']}"
+        )
+        try:
+            await bot.send_message(
+                chat_id=broadcast["report_chat_id"] or LEGACY_GROUP_ID,
+                message_thread_id=broadcast["report_thread_id"], text=text,
+            )
+        except Exception as e:
+            logging.error("Не удалось отправить отчёт о рассылке: %s", e)
+
+    async def latest(self):
+        async with db_acquire() as conn:
+            return await conn.fetchrow(f"SELECT * FROM {self.table} ORDER BY id DESC LIMIT 1")
+
+    async def stop(self):
+        async with db_acquire() as conn:
+            return await conn.fetchval(
+                f"UPDATE {self.table} SET status = 'cancelled', finished_at = NOW() "
+                f"WHERE status = 'running' RETURNING id"
+            )
+
+    async def run_resumer(self):
+        """Подхватывает рассылки, прерванные перезапуском или падением экземпляра."""
+        while True:
+            try:
+                async with db_acquire() as conn:
+                    stale = await conn.fetch(
+                        f"SELECT id FROM {self.table} WHERE status = 'running' "
+                        f"AND (claimed_by IS NULL OR updated_at < NOW() - $1::float8 * INTERVAL '1 second')",
+                        self.lease,
+                    )
+                for row in stale:
+                    asyncio.create_task(self.run(row["id"]))
+            except Exception as e:
+                logging.error("Ошибка при проверке незавершённых рассылок: %s", e)
+            await asyncio.sleep(self.lease / 2)
+
+
+# Фоновая проверка и пересоздание удалённых топиков
+TOPIC_CHECK_INTERVAL = float(os.getenv("TOPIC_CHECK_INTERVAL", "86400"))  # 0 — не проверять
+TOPIC_CHECK_RATE = float(os.getenv("TOPIC_CHECK_RATE", "5"))
+TOPIC_CHECK_BATCH_SIZE = int(os.getenv("TOPIC_CHECK_BATCH_SIZE", "200"))
+TOPIC_CREATE_PER_MINUTE = float(os.getenv("TOPIC_CREATE_PER_MINUTE", "20"))
+TOPIC_RECREATE_ATTEMPTS = int(os.getenv("TOPIC_RECREATE_ATTEMPTS", "5"))
+
+
+def topic_missing(error_message):
+    return "message thread not found" in error_message or "TOPIC_DELETED" in error_message
+
+
+class TopicReconciler:
+    """
+    Удалённые топики пересоздаются в фоне, а не в обработчике сообщения.
+    Сохранённые topic_id проверяются пачками при запуске и по расписанию
+    (sendChatAction в топик). Найденные мёртвые топики — и те, на которые
+    пожаловалась отправка, — попадают в множество dead и в очередь пересоздания
+    с ограничением частоты createForumTopic для каждой группы. Новые topic_id
+    записываются пачкой через executemany. Сообщения в мёртвый топик ждут замены в outbox.
+    Замены сохраняются в table: сообщение, адресованное старому топику, найдёт новый
+    и после перезапуска, и когда замена уже вытеснена из памяти.
+    Неудачное пересоздание повторяется с экспоненциальной задержкой не больше
+    max_attempts раз; после этого топик на give_up_seconds снимается с очереди,
+    и сообщения в него расходуют попытки и попадают в dead letters как обычно.
+    """
+
+    def __init__(self, table, check_rate=TOPIC_CHECK_RATE, check_batch=TOPIC_CHECK_BATCH_SIZE,
+                 create_per_minute=TOPIC_CREATE_PER_MINUTE, recreate_batch=20, retry_delay=2.0,
+                 replacement_retention_days=30, max_attempts=TOPIC_RECREATE_ATTEMPTS, give_up_seconds=3600):
+        self.table = table
+        self.max_attempts = max_attempts
+        self.give_up_seconds = give_up_seconds
+        self.replacement_retention_days = replacement_retention_days
+        self.check_bucket = TokenBucket(check_rate)
+        self.check_batch = check_batch
+        self.create_per_minute = create_per_minute
+        self.recreate_batch = recreate_batch
+        self.retry_delay = retry_delay
+        # topic_key мёртвых топиков; _pending — очередь пересоздания: ключ -> срок попытки
+        self.dead = set()
+        self._pending = OrderedDict()
+        self._failures = {}
+        # Топики, которые пересоздать не удалось: ключ -> время отказа
+        self._abandoned = {}
+        self._wakeup = asyncio.Event()
+        self._create_buckets = {}
+        self.checked = 0
+        self.recreated = 0
+
+    def mark_dead(self, group_id, topic_id):
+        """Ставит топик в очередь пересоздания. False, если это не топик группы."""
+        if group_id is None or not topic_id:
+            return False
+        key = topic_key(group_id, topic_id)
+        if key in self.dead:
+            return True
+        abandoned = self._abandoned.get(key)
+        if abandoned is not None and time.monotonic() - abandoned < self.give_up_seconds:
+            # Пересоздать не удалось: сообщения в топик не ждут, а расходуют попытки
+            return True
+        self._abandoned.pop(key, None)
+        logging.info("Топик %s группы %s удалён, пересоздадим его в фоне", topic_id, group_id)
+        self.dead.add(key)
+        self._pending[key] = 0.0
+        self._wakeup.set()
+        return True
+
+    def forget(self, group_id, topic_id):
+        key = topic_key(group_id, topic_id)
+        self.dead.discard(key)
+        self._pending.pop(key, None)
+        self._failures.pop(key, None)
+
+    def _postpone(self, key):
+        """Откладывает следующую попытку пересоздания или отказывается от топика."""
+        failures = self._failures[key] = self._failures.get(key, 0) + 1
+        if failures < self.max_attempts:
+            self._pending[key] = time.monotonic() + retry_delay(failures - 1, base=self.retry_delay)
+            return
+        logging.error(
+            "Топик %s группы %s не удалось пересоздать за %s попыток, сообщения в него больше не ждут",
+            key[1], key[0], failures,
+        )
+        metrics.inc("topics_recreate_abandoned_total")
+        self.forget(*key)
+        now = time.monotonic()
+        self._abandoned = {
+            abandoned: at for abandoned, at in self._abandoned.items() if now - at < self.give_up_seconds
+        }
+        self._abandoned[key] = now
+
+    async def _probe(self, group_id, topic_id):
+        delay = self.check_bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        while True:
+            try:
+                await bot.send_chat_action(chat_id=group_id, message_thread_id=topic_id, action="typing")
+                return
+            except CircuitOpenError as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                if topic_missing(str(e)):
+                    self.mark_dead(group_id, topic_id)
+                else:
+                    logging.warning("Не удалось проверить топик %s группы %s: %s", topic_id, group_id, e)
+                return
+
+    async def check(self, database_url):
+        """
+        Проверяет все сохранённые топики. Проход ведёт один экземпляр: блокировка
+        держится на отдельном соединении, чтобы не занимать пул на время проверки.
+        """
+        conn = await asyncpg.connect(database_url)
+        try:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1, 0)", LOCK_TOPIC):
+                logging.info("Топики уже проверяет другой экземпляр")
+                return
+            dead_before = len(self.dead)
+            last_id = 0
+            while True:
+                rows = await conn.fetch(
+                    f"SELECT id, group_id, topic_id FROM {TABLE_NAME} WHERE id > $1 ORDER BY id LIMIT $2",
+                    last_id, self.check_batch,
+                )
+                if not rows:
+                    break
+                last_id = rows[-1]["id"]
+                await asyncio.gather(*(self._probe(row["group_id"], row["topic_id"]) for row in rows))
+                self.checked += len(rows)
+            logging.info("Проверка топиков завершена, удалённых: %s", len(self.dead) - dead_before)
+            # Сообщения в outbox живут меньше, чем хранятся замены
+            await conn.execute(
+                f"DELETE FROM {self.table} WHERE created_at < NOW() - $1::float8 * INTERVAL '1 day'",
+                self.replacement_retention_days,
+            )
+        finally:
+            await conn.close()
+
+    async def run_checker(self, database_url, interval):
+        while True:
+            try:
+                await self.check(database_url)
+            except Exception as e:
+                logging.error("Ошибка при проверке топиков: %s", e)
+            await asyncio.sleep(interval)
+
+    async def _create_topic(self, group_id, anon_id):
+        bucket = self._create_buckets.get(group_id)
+        if bucket is None:
+            bucket = self._create_buckets[group_id] = TokenBucket(self.create_per_minute / 60)
+        delay = bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        topic = await bot.create_forum_topic(chat_id=group_id, name=f"Чат {str(anon_id)[:4]}")
+        return topic.message_thread_id
+
+    async def recreate(self, keys):
+        """
+        Пересоздаёт пачку топиков. Топики создаются вне транзакции; строки меняются
+        условным UPDATE, и если другой экземпляр успел раньше, наш топик удаляется.
+        Возвращает ключи, которые нужно попробовать позже (их попытки не расходуются).
+        """
+        async with db_acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT u.id, u.anon_id, u.group_id, u.topic_id FROM {TABLE_NAME} u "
+                f"JOIN unnest($1::bigint[], $2::integer[]) AS d(group_id, topic_id) "
+                f"ON u.group_id = d.group_id AND u.topic_id = d.topic_id",
+                [key[0] for key in keys], [key[1] for key in keys],
+            )
+        owned = {topic_key(row["group_id"], row["topic_id"]) for row in rows}
+        orphaned = [key for key in keys if key not in owned]
+        if orphaned:
+            # Топик уже заменён (раньше или другим экземпляром): берём сохранённую замену
+            async with db_acquire() as conn:
+                known = await conn.fetch(
+                    f"SELECT r.group_id, r.old_topic_id, r.new_topic_id FROM {self.table} r "
+                    f"JOIN unnest($1::bigint[], $2::integer[]) AS d(group_id, topic_id) "
+                    f"ON r.group_id = d.group_id AND r.old_topic_id = d.topic_id",
+                    [key[0] for key in orphaned], [key[1] for key in orphaned],
+                )
+            self.apply([[row["group_id"], row["old_topic_id"], row["new_topic_id"]] for row in known])
+            for key in orphaned:
+                self.forget(*key)
+
+        created, retry = [], []
+        failed = False
+        for row in rows:
+            key = topic_key(row["group_id"], row["topic_id"])
+            if retry or failed:
+                # Остальные топики пачки попробуем позже, не расходуя их попытки
+                retry.append(key)
+                continue
+            try:
+                new_topic_id = await self._create_topic(row["group_id"], row["anon_id"])
+            except CircuitOpenError:
+                # Bot API недоступен: это не отказ в создании топика, попытка не тратится
+                retry.append(key)
+                continue
+            except Exception as e:
+                logging.error("Не удалось пересоздать топик %s группы %s: %s", key[1], key[0], e)
+                self._postpone(key)
+                failed = True
+                continue
+            created.append((new_topic_id, row["id"], row["topic_id"], row["group_id"]))
+        if not created:
+            return retry
+
+        async with db_acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(
+                    f"UPDATE {TABLE_NAME} SET topic_id = $1 WHERE id = $2 AND topic_id = $3",
+                    [(new_topic_id, row_id, old_topic_id) for new_topic_id, row_id, old_topic_id, _ in created],
+                )
+                rows = await conn.fetch(
+                    f"SELECT id, topic_id FROM {TABLE_NAME} WHERE id = ANY($1::integer[])",
+                    [row_id for _, row_id, _, _ in created],
+                )
+                current = {row["id"]: row["topic_id"] for row in rows}
+                replaced = [
+                    [group_id, old_topic_id, current.get(row_id)]
+                    for _, row_id, old_topic_id, group_id in created
+                ]
+                await conn.executemany(
+                    f"INSERT INTO {self.table} (group_id, old_topic_id, new_topic_id) VALUES ($1, $2, $3) "
+                    f"ON CONFLICT (group_id, old_topic_id) DO UPDATE SET new_topic_id = EXCLUDED.new_topic_id",
+                    [item for item in replaced if item[2] is not None],
+                )
+                await cluster_events.publish(conn, "topics_changed", topics=replaced)
+
+        for new_topic_id, row_id, old_topic_id, group_id in created:
+            if current.get(row_id) != new_topic_id:
+                await delete_orphan_topic(group_id, new_topic_id)
+        self.apply(replaced)
+        self.recreated += len(created)
+        metrics.inc("topics_recreated_total", len(created))
+        logging.info("Пересоздано топиков: %s", len(created))
+        return retry
+
+    def apply(self, replaced):
+        """Переключает кэши на новые топики (свои и пришедшие от других экземпляров)."""
+        for group_id, old_topic_id, new_topic_id in replaced:
+            identity_cache.invalidate(topic_id=old_topic_id, group_id=group_id)
+            self.forget(group_id, old_topic_id)
+            if new_topic_id is not None:
+                remember_topic_replacement(group_id, old_topic_id, new_topic_id)
+
+    async def run_recreator(self):
+        while True:
+            self._wakeup.clear()
+            if not self._pending:
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            timeout = min(self._pending.values()) - now
+            if timeout > 0:
+                # Ждём ближайшую попытку или новый мёртвый топик
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            keys = list(itertools.islice((key for key, due in self._pending.items() if due <= now),
+                                         self.recreate_batch))
+            for key in keys:
+                del self._pending[key]
+            try:
+                retry = await self.recreate(keys)
+            except Exception as e:
+                logging.error("Ошибка при пересоздании топиков: %s", e)
+                for key in keys:
+                    if key in self.dead and key not in self._pending:
+                        self._postpone(key)
+                continue
+            for key in retry:
+                if key in self.dead:
+                    self._pending[key] = time.monotonic() + self.retry_delay
+
+    async def load_replacements(self):
+        """Последние замены — в память, чтобы сообщения из outbox сразу шли в новые топики."""
+        async with db_acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT group_id, old_topic_id, new_topic_id FROM {self.table} ORDER BY created_at DESC LIMIT $1",
+                TOPIC_REPLACEMENTS_SIZE,
+            )
+        for row in reversed(rows):
+            remember_topic_replacement(row["group_id"], row["old_topic_id"], row["new_topic_id"])
+
+    def start(self, database_url, check_interval=TOPIC_CHECK_INTERVAL):
+        asyncio.create_task(self.run_recreator())
+        if check_interval:
+            asyncio.create_task(self.run_checker(database_url, check_interval))
+
+    def stats(self):
+        return {"dead": len(self.dead), "pending": len(self._pending),
+                "checked": self.checked, "recreated": self.recreated}
+
+
+def redirect_to_live_topic(kwargs):
+    """
+    Подставляет замену удалённого топика в параметры отправки. Возвращает False,
+    если топик ещё ждёт пересоздания — такое сообщение нужно отложить.
+    """
+    thread_id = kwargs.get("message_thread_id")
+    if thread_id is None or kwargs.get("chat_id") is None:
+        return True
+    key = topic_key(kwargs["chat_id"], thread_id)
+    # Топик могли пересоздавать несколько раз: идём по цепочке замен
+    for _ in range(len(topic_replacements)):
+        replacement = topic_replacements.get(key)
+        if replacement is None:
+            break
+        key = (key[0], replacement)
+    kwargs["message_thread_id"] = key[1]
+    return key not in topic_reconciler.dead
+
+
+db_pool2 = None
+retry_scheduler = RetryScheduler()
+identity_cache = IdentityCache(IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+cluster_events = ClusterEvents(INSTANCE_ID)
+
+def message_link(user_row_id, group_chat_id, user_message_ids=None, group_message_ids=None):
+    """
+    Исходные сообщения одной стороны переписки (пользователя или топика): после
+    отправки — сразу или из очереди повторов — они связываются с копиями в MessageMap.
+    """
+    if user_row_id is None:
+        return None
+    source, message_ids = ("user", user_message_ids) if user_message_ids else ("group", group_message_ids)
+    return {"row_id": user_row_id, "group_id": group_chat_id, "source": source, "message_ids": list(message_ids)}
+
+
+def record_message_link(link, sent):
+    if not link or not sent:
+        return
+    # copyMessage возвращает один MessageId, sendMediaGroup — список сообщений альбома
+    copies = sent if isinstance(sent, list) else [sent]
+    for source_id, copy in zip(link["message_ids"], copies):
+        if link["source"] == "user":
+            message_map.add(link["row_id"], source_id, link["group_id"], copy.message_id)
+        else:
+            message_map.add(link["row_id"], copy.message_id, link["group_id"], source_id)
+
+
+async def safe_send(send_method, link=None, notify_chat_id=None, **kwargs):
+    """
+    Отправляет сообщение, а при ошибке сохраняет его для повторной отправки.
+    notify_chat_id — чат автора сообщения: его один раз за сбой предупреждают
+    о проблемах с сетью (получатель, например группа с топиками, не предупреждается).
+    """
+    if not redirect_to_live_topic(kwargs):
+        # Топик пересоздаётся в фоне — сообщение дождётся его в outbox, не задерживая обработчик
+        outbox.enqueue(send_method, kwargs, retry_after=topic_reconciler.retry_delay, link=link)
+        return None
     try:
-        return await send_method(**kwargs)
+        sent = await send_method(**kwargs)
+        record_message_link(link, sent)
+        return sent
+    except CircuitOpenError as e:
+        # Bot API недоступен: сразу в очередь повторов, без сетевых вызовов
+        outbox.enqueue(send_method, kwargs, retry_after=e.retry_after, link=link)
+        return None
     except Exception as e:
         error_message = str(e)
-        logging.error(f"Ошибка отправки, сообщение сохранено для повторной отправки: {error_message}")
+        logging.error("Ошибка отправки, сообщение сохранено для повторной отправки: %s", error_message)
 
         # Проверяем, заблокирован ли бот пользователем
         if "bot was blocked by the user" in error_message:
             logging.info("Бот заблокирован пользователем. Сообщение не будет повторно отправлено.")
             return None
 
-        # Проверяем, если тред не найден, создаем новый
-        if "message thread not found" in error_message:
-            logging.info("Тред не найден, создаем новый тред.")
-            chat_id = kwargs.get('chat_id')
-            if chat_id:
-                async with db_pool2.acquire() as conn:
-                    # Получаем анонимный ID пользователя
-                    result = await conn.fetchrow(
-                        f"SELECT anon_id FROM {TABLE_NAME} WHERE telegram_id = $1",
-                        encrypt_telegram_id(str(chat_id))
-                    )
-                    if result:
-                        anon_id = result['anon_id']
-                        topic_title = f"Чат {anon_id[:4]}"
-                        topic_result = await bot.create_forum_topic(
-                            chat_id=GROUP_ID, name=topic_title
-                        )
-                        new_topic_id = topic_result.message_thread_id
+        # Правку без изменений или слишком старого сообщения повторять бессмысленно
+        if "message is not modified" in error_message or "message can't be edited" in error_message:
+            logging.info("Правка не применена: %s", error_message)
+            return None
 
-                        # Обновляем topic_id в базе данных
-                        await conn.execute(
-                            f"UPDATE {TABLE_NAME} SET topic_id = $1 WHERE telegram_id = $2",
-                            new_topic_id, encrypt_telegram_id(str(chat_id))
-                        )
-                        logging.info(f"Создан новый тред с ID {new_topic_id} для пользователя {chat_id}.")
-                        # Пытаемся отправить сообщение в новый тред
-                        kwargs['message_thread_id'] = new_topic_id
-                        return await send_method(**kwargs)
+        # Топик удалён: пересоздаём его в фоне, сообщение отправится в новый топик из outbox
+        if topic_missing(error_message):
+            if topic_reconciler.mark_dead(kwargs.get('chat_id'), kwargs.get('message_thread_id')):
+                outbox.enqueue(send_method, kwargs, retry_after=topic_reconciler.retry_delay, link=link)
             return None
 
-        retry_queue.append({
-            'send_method': send_method,
-            'kwargs': kwargs,
-        })
+        outbox.enqueue(
+            send_method, kwargs,
+            retry_after=e.retry_after if isinstance(e, TelegramRetryAfter) else None,
+            link=link,
+        )
 
-        # Пытаемся уведомить пользователя о проблемах, если указан chat_id
-        if 'chat_id' in kwargs:
+        # Уведомляем автора о проблемах не чаще одного раза за сбой
+        if notify_chat_id is not None and api_breaker.should_notify(notify_chat_id):
             try:
-                await bot.send_message(chat_id=kwargs['chat_id'],
+                await bot.send_message(chat_id=notify_chat_id,
                                        text="Сейчас возникли проблемы с сетью. "
                                             "Ваше сообщение будет отправлено, как только связь восстановится.")
             except Exception as inner:
-                logging.error(f"Не удалось отправить уведомление пользователю: {inner}")
+                logging.error("Не удалось отправить уведомление пользователю: %s", inner)
         return None
 
 
 # Асинхронная функция для логирования состояния пула
 async def log_pool_state():
     try:
-        active_connections = len(db_pool2._holders)  # Занятые соединения
-        free_connections = db_pool2._queue.qsize()  # Свободные соединения
+        active_connections = db_pool2.get_size() - db_pool2.get_idle_size()  # Занятые соединения
+        free_connections = db_pool2.get_idle_size()  # Свободные соединения
         logging.info(
-            f"Пул соединений db_pool2: Активных соединений: {active_connections}, Свободных соединений: {free_connections}"
+            "Пул соединений db_pool2: Активных соединений: %s, Свободных соединений: %s", active_connections, free_connections
         )
     except Exception as e:
-        logging.error(f"Ошибка при логировании состояния пула db_pool2: {e}")
+        logging.error("Ошибка при логировании состояния пула db_pool2: %s", e)
 
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GROUP_ID = os.getenv("GROUP_ID")
+# Группы с топиками через запятую, у каждой необязательный вес: "-1001=2,-1002,-1003=0".
+# Вес 0 — группа больше не принимает новых пользователей, но продолжает работать.
+GROUP_IDS = {
+    int(group_id): float(weight) if weight else 1.0
+    for group_id, weight in _parse_settings(os.getenv("GROUP_IDS", GROUP_ID or "")).items()
+}
+# Группа, где жили пользователи, зарегистрированные до появления GROUP_IDS
+LEGACY_GROUP_ID = int(GROUP_ID) if GROUP_ID else next(iter(GROUP_IDS), None)
+if LEGACY_GROUP_ID is not None:
+    GROUP_IDS.setdefault(LEGACY_GROUP_ID, 0.0)
+GROUP_ASSIGNMENT = os.getenv("GROUP_ASSIGNMENT", "hash")  # hash или least_loaded
+GROUP_LOAD_REFRESH = float(os.getenv("GROUP_LOAD_REFRESH", "600"))
 TABLE_NAME = os.getenv("TABLE_NAME", "an_users")
+OUTBOX_TABLE = os.getenv("OUTBOX_TABLE", f"{TABLE_NAME}_outbox")
+MESSAGE_MAP_TABLE = os.getenv("MESSAGE_MAP_TABLE", f"{TABLE_NAME}_messages")
+BROADCAST_TABLE = os.getenv("BROADCAST_TABLE", f"{TABLE_NAME}_broadcasts")
+TOPIC_REPLACEMENTS_TABLE = os.getenv("TOPIC_REPLACEMENTS_TABLE", f"{TABLE_NAME}_topic_replacements")
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+# Сколько дней хранить сообщения, которые так и не удалось отправить
+OUTBOX_DEAD_RETENTION_DAYS = float(os.getenv("OUTBOX_DEAD_RETENTION_DAYS", "7"))
+# Канал LISTEN/NOTIFY для согласования экземпляров бота
+CLUSTER_CHANNEL = os.getenv("CLUSTER_CHANNEL", f"{TABLE_NAME}_events")
+
+outbox = Outbox(OUTBOX_TABLE, workers=OUTBOX_WORKERS, dead_retention_days=OUTBOX_DEAD_RETENTION_DAYS)
+message_map = MessageMap(MESSAGE_MAP_TABLE)
+broadcaster = Broadcaster(BROADCAST_TABLE)
+group_router = GroupRouter(GROUP_IDS, GROUP_ASSIGNMENT)
+topic_reconciler = TopicReconciler(TOPIC_REPLACEMENTS_TABLE)
+
+# Время каждого запроса попадает в гистограмму по типу операции (SELECT, UPDATE, ...)
+def _log_query(record):
+    operation = record.query.lstrip().split(None, 1)[0].upper() if record.query.strip() else "OTHER"
+    metrics.observe("db_query_duration_seconds", record.elapsed, operation=operation)
+    if record.exception is not None:
+        metrics.inc("bot_errors_total", error=type(record.exception).__name__, source="db")
+
+
+async def _init_connection(conn):
+    conn.add_query_logger(_log_query)
+
+
+# Соединение из пула с учётом времени ожидания
+@contextlib.asynccontextmanager
+async def db_acquire():
+    started = time.monotonic()
+    async with db_pool2.acquire() as conn:
+        metrics.observe("db_pool_acquire_seconds", time.monotonic() - started)
+        yield conn
+
 
 # Асинхронная функция для создания пула подключения
 async def get_db_pool2():
@@ -147,79 +2395,640 @@ async def get_db_pool2():
         if not DATABASE_URL:
             raise ValueError("DATABASE_URL не задана.")
 
-        return await asyncpg.create_pool(DATABASE_URL, max_size=10)
+        return await asyncpg.create_pool(DATABASE_URL, max_size=10, init=_init_connection)
     except Exception as e:
-        logging.error(f"Ошибка при подключении к базе данных: {e}")
+        logging.error("Ошибка при подключении к базе данных: %s", e)
         raise
 
 
+# Миграции схемы.
+# Каждая миграция применяется один раз, номер версии записывается в SCHEMA_MIGRATIONS_TABLE.
+# Индексы на существующих таблицах создаются CONCURRENTLY (вне транзакции), чтобы не
+# блокировать запись; поэтому все шаги идемпотентны и миграцию можно перезапустить.
+SCHEMA_MIGRATIONS_TABLE = os.getenv("SCHEMA_MIGRATIONS_TABLE", f"{TABLE_NAME}_schema_migrations")
+MIGRATION_LOCK_POLL = 1.0  # секунд между попытками взять блокировку миграций
+
+
+async def create_index_concurrently(conn, name, definition):
+    # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс — удаляем его
+    invalid = await conn.fetchval(
+        "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", name
+    )
+    if invalid:
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    await conn.execute(f"CREATE {definition}")
+
+
+async def _migration_create_users(conn):
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+            id SERIAL PRIMARY KEY,
+            telegram_id TEXT NOT NULL,
+            anon_id UUID NOT NULL,
+            topic_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+
+
+async def _migration_telegram_id_unique(conn):
+    # Дубликаты, которые успела создать гонка регистраций, не дадут построить индекс:
+    # оставляем самую раннюю строку каждого пользователя. Зависимых таблиц на этой
+    # версии схемы ещё нет; лишние топики остаются в группе, их номера — в логе.
+    duplicates = await conn.fetch(f"""
+        DELETE FROM {TABLE_NAME} AS duplicate USING {TABLE_NAME} AS kept
+        WHERE duplicate.telegram_id = kept.telegram_id AND duplicate.id > kept.id
+        RETURNING duplicate.id, duplicate.topic_id
+    """)
+    if duplicates:
+        topics = sorted({row["topic_id"] for row in duplicates})
+        logging.warning(
+            "Удалено повторных регистраций: %s, лишних топиков: %s, первые из них: %s",
+            len(duplicates), len(topics), topics[:20],
+        )
+    # Нужен для INSERT ... ON CONFLICT в register_user
+    await create_index_concurrently(
+        conn, f"{TABLE_NAME}_telegram_id_key",
+        f"UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {TABLE_NAME}_telegram_id_key ON {TABLE_NAME} (telegram_id)",
+    )
+
+
+async def _migration_blind_index(conn):
+    # Слепой индекс для поиска пользователя по Telegram ID
+    await conn.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS telegram_id_bidx BYTEA")
+    await create_index_concurrently(
+        conn, f"{TABLE_NAME}_telegram_id_bidx_key",
+        f"UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {TABLE_NAME}_telegram_id_bidx_key "
+        f"ON {TABLE_NAME} (telegram_id_bidx)",
+    )
+
+
+async def _migration_lookup_indexes(conn):
+    # Ответы администраторов ищут пользователя по topic_id, get_telegram_id — по anon_id
+    await create_index_concurrently(
+        conn, f"{TABLE_NAME}_topic_id_idx",
+        f"INDEX CONCURRENTLY IF NOT EXISTS {TABLE_NAME}_topic_id_idx ON {TABLE_NAME} (topic_id)",
+    )
+    await create_index_concurrently(
+        conn, f"{TABLE_NAME}_anon_id_key",
+        f"UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {TABLE_NAME}_anon_id_key ON {TABLE_NAME} (anon_id)",
+    )
+
+
+async def _migration_outbox(conn):
+    # Очередь неотправленных сообщений и индекс по сроку следующей попытки
+    async with conn.transaction():
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {OUTBOX_TABLE} (
+                id BIGSERIAL PRIMARY KEY,
+                method TEXT NOT NULL,
+                payload JSONB NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                due_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                last_error TEXT,
+                dead BOOLEAN NOT NULL DEFAULT FALSE
+            )
+        """)
+        await conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {OUTBOX_TABLE}_due_at_idx "
+            f"ON {OUTBOX_TABLE} (due_at) WHERE NOT dead"
+        )
+
+
+async def _migration_outbox_claimed_by(conn):
+    # Какой экземпляр бота сейчас отправляет строку (для диагностики)
+    await conn.execute(f"ALTER TABLE {OUTBOX_TABLE} ADD COLUMN IF NOT EXISTS claimed_by TEXT")
+
+
+async def _migration_message_map(conn):
+    # Партиции на каждый день создаёт MessageMap.maintain при запуске и раз в час
+    async with conn.transaction():
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {MESSAGE_MAP_TABLE} (
+                user_row_id INTEGER NOT NULL,
+                user_message_id BIGINT NOT NULL,
+                group_chat_id BIGINT NOT NULL,
+                group_message_id BIGINT NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            ) PARTITION BY RANGE (created_at)
+        """)
+        await conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {MESSAGE_MAP_TABLE}_group_idx "
+            f"ON {MESSAGE_MAP_TABLE} (group_chat_id, group_message_id)"
+        )
+        await conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {MESSAGE_MAP_TABLE}_user_idx "
+            f"ON {MESSAGE_MAP_TABLE} (user_row_id, user_message_id)"
+        )
+
+
+async def _migration_broadcasts(conn):
+    # Рассылки и их прогресс: last_user_id — id последнего обработанного пользователя
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {BROADCAST_TABLE} (
+            id BIGSERIAL PRIMARY KEY,
+            created_by BIGINT NOT NULL,
+            report_thread_id BIGINT,
+            source_chat_id BIGINT,
+            source_message_id BIGINT,
+            text TEXT,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            delivered INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            claimed_by TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMPTZ
+        )
+    """)
+
+
+async def _migration_user_groups(conn):
+    # Группа хранится рядом с topic_id. Существующие пользователи остаются в LEGACY_GROUP_ID:
+    # ADD COLUMN с постоянным значением по умолчанию не переписывает таблицу
+    if LEGACY_GROUP_ID is None:
+        raise ValueError("Для миграции нужна GROUP_ID или GROUP_IDS.")
+    async with conn.transaction():
+        await conn.execute(
+            f"ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS group_id BIGINT NOT NULL DEFAULT {LEGACY_GROUP_ID}"
+        )
+        await conn.execute(f"ALTER TABLE {TABLE_NAME} ALTER COLUMN group_id DROP DEFAULT")
+        await conn.execute(f"ALTER TABLE {BROADCAST_TABLE} ADD COLUMN IF NOT EXISTS report_chat_id BIGINT")
+    # Ответы администраторов ищут пользователя по (группа, topic_id); старый индекс больше не нужен
+    await create_index_concurrently(
+        conn, f"{TABLE_NAME}_group_topic_idx",
+        f"INDEX CONCURRENTLY IF NOT EXISTS {TABLE_NAME}_group_topic_idx ON {TABLE_NAME} (group_id, topic_id)",
+    )
+    await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {TABLE_NAME}_topic_id_idx")
+
+
+async def _migration_topic_replacements(conn):
+    # Старый топик -> новый, для сообщений, отправленных до пересоздания
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TOPIC_REPLACEMENTS_TABLE} (
+            group_id BIGINT NOT NULL,
+            old_topic_id INTEGER NOT NULL,
+            new_topic_id INTEGER NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (group_id, old_topic_id)
+        )
+    """)
+
+
+MIGRATIONS = [
+    (1, "таблица пользователей", _migration_create_users),
+    (2, "уникальный индекс telegram_id", _migration_telegram_id_unique),
+    (3, "слепой индекс telegram_id_bidx", _migration_blind_index),
+    (4, "индексы topic_id и anon_id", _migration_lookup_indexes),
+    (5, "таблица outbox", _migration_outbox),
+    (6, "владелец строки outbox", _migration_outbox_claimed_by),
+    (7, "связи сообщений с партициями по дням", _migration_message_map),
+    (8, "таблица рассылок", _migration_broadcasts),
+    (9, "группа пользователя рядом с topic_id", _migration_user_groups),
+    (10, "замены удалённых топиков", _migration_topic_replacements),
+]
+
+
+async def run_migrations():
+    """
+    Применяет недостающие миграции. Advisory lock не даёт нескольким
+    процессам выполнять миграции одновременно.
+    """
+    async with db_acquire() as conn:
+        # Ждём блокировку опросом, а не блокирующим pg_advisory_lock: ожидающий запрос
+        # держит снимок, а CREATE INDEX CONCURRENTLY у владельца ждёт завершения
+        # старых снимков — экземпляры ждали бы друг друга до DeadlockDetectedError
+        while not await conn.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", SCHEMA_MIGRATIONS_TABLE):
+            logging.info("Миграции выполняет другой экземпляр, ждём")
+            await asyncio.sleep(MIGRATION_LOCK_POLL)
+        try:
+            await conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {SCHEMA_MIGRATIONS_TABLE} (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                )
+            """)
+            applied = {
+                row["version"]
+                for row in await conn.fetch(f"SELECT version FROM {SCHEMA_MIGRATIONS_TABLE}")
+            }
+            for version, description, migrate in MIGRATIONS:
+                if version in applied:
+                    continue
+                logging.info("Применяется миграция %s: %s", version, description)
+                await migrate(conn)
+                await conn.execute(
+                    f"INSERT INTO {SCHEMA_MIGRATIONS_TABLE} (version, description) VALUES ($1, $2)",
+                    version, description,
+                )
+            logging.info("Версия схемы: %s", max(version for version, _, _ in MIGRATIONS))
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(hashtext($1))", SCHEMA_MIGRATIONS_TABLE)
+
+
+# Заполнение слепого индекса для строк, созданных до его появления
+async def backfill_blind_index(batch_size=1000):
+    last_id = 0
+    filled = 0
+    while True:
+        async with db_acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT id, telegram_id FROM {TABLE_NAME} "
+                f"WHERE id > $1 AND telegram_id_bidx IS NULL ORDER BY id LIMIT $2",
+                last_id, batch_size,
+            )
+            if not rows:
+                break
+            updates = []
+            for row in rows:
+                try:
+                    updates.append((row["id"], blind_index(decrypt_telegram_id(row["telegram_id"]))))
+                except ValueError as e:
+                    logging.error("Не удалось расшифровать строку %s: %s", row['id'], e)
+            await conn.executemany(
+                f"UPDATE {TABLE_NAME} SET telegram_id_bidx = $2 WHERE id = $1", updates
+            )
+        last_id = rows[-1]["id"]
+        filled += len(updates)
+    if filled:
+        logging.info("Слепой индекс заполнен для %s пользователей", filled)
+
+
+# Ротация ключа шифрования: перешифровка всей таблицы пачками.
+# Чтение идёт серверным курсором в снимке только для чтения, запись — короткими
+# транзакциями на отдельном соединении, поэтому таблица не блокируется.
+async def rotate_encryption_key(old_key, new_key, batch_size=1000):
+    if not DATABASE_URL:
+        raise ValueError("DATABASE_URL не задана.")
+    reader = await asyncpg.connect(DATABASE_URL)
+    writer = await asyncpg.connect(DATABASE_URL)
+    rotated = skipped = 0
+    try:
+        async with reader.transaction(isolation="repeatable_read", readonly=True):
+            cursor = await reader.cursor(f"SELECT id, telegram_id FROM {TABLE_NAME} ORDER BY id")
+            while True:
+                rows = await cursor.fetch(batch_size)
+                if not rows:
+                    break
+                updates = []
+                for row in rows:
+                    try:
+                        telegram_id = decrypt_telegram_id(row["telegram_id"], key=old_key)
+                        if not telegram_id.isdigit():
+                            raise ValueError("не Telegram ID")
+                    except ValueError:
+                        # Строка уже зашифрована новым ключом (повторный запуск)
+                        skipped += 1
+                        continue
+                    updates.append((
+                        row["id"],
+                        encrypt_telegram_id(telegram_id, key=new_key),
+                        blind_index(telegram_id),
+                        row["telegram_id"],
+                    ))
+                if updates:
+                    async with writer.transaction():
+                        # Условие по старому значению защищает от гонки с работающим ботом
+                        await writer.executemany(
+                            f"UPDATE {TABLE_NAME} SET telegram_id = $2, telegram_id_bidx = $3 "
+                            f"WHERE id = $1 AND telegram_id = $4",
+                            updates,
+                        )
+                rotated += len(updates)
+                logging.info("Перешифровано %s строк, пропущено %s", rotated, skipped)
+    finally:
+        await reader.close()
+        await writer.close()
+    return rotated, skipped
+
+
+# Настройки HTTP-сессии Bot API
+BOT_API_CONNECTIONS = int(os.getenv("BOT_API_CONNECTIONS", "100"))
+BOT_API_KEEPALIVE = float(os.getenv("BOT_API_KEEPALIVE", "60"))
+BOT_API_DNS_CACHE_TTL = int(os.getenv("BOT_API_DNS_CACHE_TTL", "3600"))
+BOT_API_TIMEOUT = float(os.getenv("BOT_API_TIMEOUT", "60"))
+# Таймауты отдельных методов, например "sendMediaGroup=120,copyMessage=20"
+BOT_API_METHOD_TIMEOUTS = os.getenv("BOT_API_METHOD_TIMEOUTS", "sendMediaGroup=120,sendDocument=120,sendVideo=120")
+# Кодек JSON: auto (orjson, затем ujson, затем стандартный json), orjson, ujson или json
+JSON_CODEC = os.getenv("JSON_CODEC", "auto")
+
+
+def parse_method_timeouts(value):
+    timeouts = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        method, _, seconds = item.partition("=")
+        timeouts[method.strip()] = float(seconds)
+    return timeouts
+
+
+def load_json_codec(name=JSON_CODEC):
+    """
+    Возвращает (имя, loads, dumps). Быстрые библиотеки необязательны:
+    если их нет, используется стандартный json.
+    """
+    candidates = ["orjson", "ujson", "json"] if name == "auto" else [name]
+    for candidate in candidates:
+        if candidate == "orjson":
+            try:
+                import orjson
+            except ImportError:
+                continue
+            # orjson возвращает bytes, а aiogram ожидает str
+            return "orjson", orjson.loads, lambda obj: orjson.dumps(obj).decode()
+        if candidate == "ujson":
+            try:
+                import ujson
+            except ImportError:
+                continue
+            return "ujson", ujson.loads, ujson.dumps
+        if candidate == "json":
+            return "json", json.loads, json.dumps
+    logging.warning("JSON-кодек %s недоступен, используется стандартный json", name)
+    return "json", json.loads, json.dumps
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """
+    Сессия Bot API с таймаутами по методам и настраиваемым keep-alive.
+    Пул на 100 соединений и кэш DNS на час aiogram включает и сам; здесь они
+    лишь вынесены в настройки.
+
+    Параметры соединителя aiogram публично не принимает: они дописываются в его
+    внутренний _connector_init (тот же словарь aiogram заполняет для прокси).
+    Если в новой версии aiogram его не окажется, сессия работает со значениями
+    по умолчанию.
+    """
+
+    def __init__(self, limit=BOT_API_CONNECTIONS, keepalive_timeout=BOT_API_KEEPALIVE,
+                 dns_cache_ttl=BOT_API_DNS_CACHE_TTL, method_timeouts=None, **kwargs):
+        super().__init__(limit=limit, **kwargs)
+        connector_init = getattr(self, "_connector_init", None)
+        if isinstance(connector_init, dict):
+            connector_init.update(
+                # Все запросы идут на один хост api.telegram.org
+                limit_per_host=limit,
+                keepalive_timeout=keepalive_timeout,
+                ttl_dns_cache=dns_cache_ttl,
+            )
+        else:
+            logging.warning("aiogram не даёт настроить соединитель: keep-alive и кэш DNS по умолчанию")
+        self.method_timeouts = method_timeouts or {}
+
+    async def make_request(self, bot, method, timeout=None):
+        if timeout is None:
+            timeout = self.method_timeouts.get(method.__api_method__)
+        return await super().make_request(bot, method, timeout=timeout)
+
+
+# Все исходящие сообщения проходят через ограничитель частоты
+send_rate_limiter = SendRateLimiter(group_ids=GROUP_IDS)
+api_breaker = CircuitBreaker()
+
+
+def create_bot_session(tuned=True, json_codec=JSON_CODEC):
+    codec_name, json_loads, json_dumps = load_json_codec(json_codec)
+    if tuned:
+        session = TunedAiohttpSession(
+            method_timeouts=parse_method_timeouts(BOT_API_METHOD_TIMEOUTS),
+            timeout=BOT_API_TIMEOUT,
+            json_loads=json_loads,
+            json_dumps=json_dumps,
+        )
+    else:
+        session = AiohttpSession(json_loads=json_loads, json_dumps=json_dumps)
+    # Разомкнутый выключатель отказывает сразу, не занимая место в очереди ограничителя;
+    # пробный запрос выбирается и учитывается уже после ожидания в ограничителе
+    session.middleware(CircuitGateMiddleware(api_breaker))
+    session.middleware(send_rate_limiter)
+    session.middleware(CircuitBreakerMiddleware(api_breaker))
+    session.middleware(ApiMetricsMiddleware())
+    logging.info("Сессия Bot API: %s, JSON: %s", 'настроенная' if tuned else 'стандартная', codec_name)
+    return session
+
+
 # Создание бота
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=BOT_TOKEN, session=create_bot_session())
 
 # Создание диспетчера без передачи бота
 dp = Dispatcher()
 
+# Сообщения одного пользователя/топика обрабатываются строго по порядку
+conversation_scheduler = KeyedScheduler()
+dp.update.outer_middleware(OrderedUpdateMiddleware(conversation_scheduler))
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.edited_message.middleware(HandlerMetricsMiddleware())
+
+# Альбомы пересылаются одним send_media_group
+media_groups = MediaGroupBuffer(conversation_scheduler)
+
+
+
+# Незавершённые операции по ключу: конкурентные вызовы ждут один и тот же результат
+_inflight = {}
+
+# Соответствие старых (удалённых) топиков новым, ограниченное по размеру
+topic_replacements = OrderedDict()
+TOPIC_REPLACEMENTS_SIZE = 1000
+
+
+async def single_flight(key, factory):
+    """
+    Выполняет factory() один раз для всех одновременных вызовов с одним ключом.
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _inflight[key] = task
+
+        def _forget(done_task):
+            if _inflight.get(key) is done_task:
+                del _inflight[key]
+
+        task.add_done_callback(_forget)
+    # shield: отмена одного ожидающего не отменяет общую операцию
+    return await asyncio.shield(task)
+
+
+# Удаление топика, созданного впустую (другой процесс успел раньше)
+async def delete_orphan_topic(group_id, topic_id):
+    try:
+        await bot.delete_forum_topic(chat_id=group_id, message_thread_id=topic_id)
+    except Exception as e:
+        logging.error("Не удалось удалить лишний топик %s: %s", topic_id, e)
+
+
+def remember_topic_replacement(group_id, old_topic_id, new_topic_id):
+    topic_replacements[topic_key(group_id, old_topic_id)] = new_topic_id
+    while len(topic_replacements) > TOPIC_REPLACEMENTS_SIZE:
+        topic_replacements.popitem(last=False)
 
 
 # Регистрация пользователя с созданием нового топика
 async def register_user(telegram_id: str):
     """
     Регистрирует пользователя, создавая анонимный ID и топик для взаимодействия.
+    Возвращает (anon_id, группа, topic_id). Одновременные регистрации одного
+    пользователя объединяются в одну.
     """
+    cached = identity_cache.get(telegram_id)
+    if cached:
+        return cached.anon_id, cached.group_id, cached.topic_id
+
+    return await single_flight(
+        ("register", str(telegram_id)), lambda: _register_user(telegram_id)
+    )
+
+
+async def _register_user(telegram_id: str):
     try:
-        logging.info(f"Регистрация пользователя с Telegram ID: {telegram_id}")
-        # Шифруем Telegram ID для использования в базе данных
+        logging.info("Регистрация пользователя %s", UserRef(telegram_id))
+        # Шифруем Telegram ID для хранения, а ищем по слепому индексу
         encrypted_id = encrypt_telegram_id(str(telegram_id))
-        async with db_pool2.acquire() as conn:
+        lookup_key = blind_index(telegram_id)
+        async with db_acquire() as conn:
             # Проверяем, зарегистрирован ли пользователь
             result = await conn.fetchrow(
-                f"SELECT anon_id, topic_id FROM {TABLE_NAME} WHERE telegram_id = $1",
-                encrypted_id,
+                f"SELECT id, anon_id, group_id, topic_id FROM {TABLE_NAME} WHERE telegram_id_bidx = $1",
+                lookup_key,
             )
-            if result:
-                logging.info(f"Пользователь {telegram_id} уже зарегистрирован.")
-                return result["anon_id"], result["topic_id"]
+        if not result:
+            return await _create_user(telegram_id, encrypted_id, lookup_key)
+        logging.info("Пользователь %s уже зарегистрирован.", UserRef(telegram_id))
+        identity = identity_cache.put(
+            telegram_id, result["id"], result["anon_id"], result["topic_id"], result["group_id"]
+        )
+        return identity.anon_id, identity.group_id, identity.topic_id
 
-            # Генерация анонимного ID
-            anon_id = str(uuid.uuid4())
+    except Exception as e:
+        logging.error("Ошибка при регистрации пользователя %s: %s", UserRef(telegram_id), e)
+        return None, None, None
 
-            # Создание нового топика
-            topic_title = f"Чат {anon_id[:4]}"
-            topic_result = await bot.create_forum_topic(
-                chat_id=GROUP_ID, name=topic_title
-            )
-            topic_id = topic_result.message_thread_id
 
-            # Сохранение зашифрованного Telegram ID в базе данных
-            await conn.execute(
-                f"INSERT INTO {TABLE_NAME} (telegram_id, anon_id, topic_id) VALUES ($1, $2, $3)",
-                encrypted_id,
-                anon_id,
-                topic_id,
-            )
-            logging.info(
-                f"Создан новый топик с ID {topic_id} для пользователя {telegram_id}."
+async def _create_user(telegram_id, encrypted_id, lookup_key):
+    # Соединение из пула на время запроса к Bot API не занимается. Одновременную
+    # регистрацию в другом экземпляре бота отсекает уникальный слепой индекс:
+    # проигравший удаляет свой топик.
+
+    # Генерация анонимного ID
+    anon_id = str(uuid.uuid4())
+
+    # Создание нового топика в группе, выбранной для пользователя
+    group_id = group_router.assign(lookup_key)
+    # Учитываем сразу: параллельные регистрации не должны выбрать ту же группу по старым счётчикам
+    group_router.record(group_id)
+    topic_title = f"Чат {anon_id[:4]}"
+    topic_result = await bot.create_forum_topic(
+        chat_id=group_id, name=topic_title
+    )
+    topic_id = topic_result.message_thread_id
+
+    # Сохранение зашифрованного Telegram ID в базе данных
+    async with db_acquire() as conn:
+        row_id = await conn.fetchval(
+            f"INSERT INTO {TABLE_NAME} (telegram_id, telegram_id_bidx, anon_id, group_id, topic_id) "
+            f"VALUES ($1, $2, $3, $4, $5) ON CONFLICT (telegram_id_bidx) DO NOTHING RETURNING id",
+            encrypted_id,
+            lookup_key,
+            anon_id,
+            group_id,
+            topic_id,
+        )
+        if row_id is None:
+            result = await conn.fetchrow(
+                f"SELECT id, anon_id, group_id, topic_id FROM {TABLE_NAME} WHERE telegram_id_bidx = $1",
+                lookup_key,
             )
-            return anon_id, topic_id
+    if row_id is None:
+        # Пользователя уже зарегистрировал другой процесс — наш топик лишний
+        await delete_orphan_topic(group_id, topic_id)
+        identity = identity_cache.put(
+            telegram_id, result["id"], result["anon_id"], result["topic_id"], result["group_id"]
+        )
+        return identity.anon_id, identity.group_id, identity.topic_id
 
-    except Exception as e:
-        logging.error(f"Ошибка при регистрации пользователя {telegram_id}: {e}")
-        return None, None
+    identity_cache.put(telegram_id, row_id, anon_id, topic_id, group_id)
+    logging.info(
+        "Создан новый топик с ID %s в группе %s для пользователя %s.", topic_id, group_id, UserRef(telegram_id)
+    )
+    return anon_id, group_id, topic_id
 
 
 # Получение Telegram ID по анонимному ID
 async def get_telegram_id(anon_id):
-    async with db_pool2.acquire() as conn:
+    telegram_id = identity_cache.get_by_anon(anon_id)
+    if telegram_id:
+        return telegram_id
+
+    async with db_acquire() as conn:
         result = await conn.fetchrow(
-            f"SELECT telegram_id FROM {TABLE_NAME} WHERE anon_id = $1", anon_id
+            f"SELECT id, telegram_id, anon_id, group_id, topic_id FROM {TABLE_NAME} WHERE anon_id = $1", anon_id
         )
-        return decrypt_telegram_id(result["telegram_id"]) if result else None
+    if not result:
+        return None
+    telegram_id = decrypt_telegram_id(result["telegram_id"])
+    identity_cache.put(telegram_id, result["id"], result["anon_id"], result["topic_id"], result["group_id"])
+    return telegram_id
+
+
+# Получение Telegram ID по группе и ID топика в ней
+async def get_telegram_id_by_topic(group_id, topic_id):
+    telegram_id = identity_cache.get_by_topic(topic_id, group_id)
+    if telegram_id:
+        return telegram_id
+
+    async with db_acquire() as conn:
+        result = await conn.fetchrow(
+            f"SELECT id, telegram_id, anon_id FROM {TABLE_NAME} WHERE group_id = $1 AND topic_id = $2",
+            group_id, topic_id,
+        )
+    if not result:
+        return None
+    telegram_id = decrypt_telegram_id(result["telegram_id"])
+    identity_cache.put(telegram_id, result["id"], result["anon_id"], topic_id, group_id)
+    return telegram_id
+
+
+# Номер строки пользователя (ключ в связях сообщений), обычно из кэша
+async def get_user_row_id(telegram_id):
+    cached = identity_cache.get(telegram_id)
+    if cached:
+        return cached.row_id
+    async with db_acquire() as conn:
+        return await conn.fetchval(
+            f"SELECT id FROM {TABLE_NAME} WHERE telegram_id_bidx = $1", blind_index(telegram_id)
+        )
+
+
+def replied_message_id(message: types.Message):
+    """ID сообщения, на которое ответили. В топике «ответ» на его первое сообщение ответом не считается."""
+    reply = message.reply_to_message
+    if reply is None or (message.is_topic_message and reply.message_id == message.message_thread_id):
+        return None
+    return reply.message_id
+
+
+async def linked_reply(message: types.Message, lookup, owner_id):
+    """
+    Ответ на сообщение по одну сторону превращается в ответ на связанное
+    с ним сообщение по другую. lookup — message_map.by_user или message_map.by_group.
+    """
+    replied_id = replied_message_id(message)
+    if replied_id is None:
+        return {}
+    linked = await lookup(owner_id, replied_id)
+    if linked is None:
+        return {}
+    return {"reply_parameters": ReplyParameters(message_id=linked[1], allow_sending_without_reply=True)}
 
 
 @dp.message(Command("start"))
 async def start_command(message: types.Message):
 
-    anon_id, topic_id = await register_user(message.from_user.id)
+    await register_user(message.from_user.id)
 
     # Создаем кнопки
     keyboard = ReplyKeyboardMarkup(
@@ -247,22 +3056,61 @@ async def fill_form(message: types.Message):
 async def contact_volunteer(message: types.Message):
     try:
 
-        # Получаем номер строки в базе, используя зашифрованный Telegram ID
-        async with db_pool2.acquire() as conn:
-            encrypted_id = encrypt_telegram_id(str(message.from_user.id))
-            result = await conn.fetchrow(
-                f"SELECT id FROM {TABLE_NAME} WHERE telegram_id = $1", encrypted_id
-            )
-
-        if result:
-            user_number = result["id"]
+        # Получаем номер строки в базе по слепому индексу Telegram ID
+        user_number = await get_user_row_id(message.from_user.id)
 
+        if user_number:
             await message.answer(
                 f"Добро пожаловать! Здесь ты можешь написать нам. Ты будешь общаться с администраторами через бота, поэтому ты останешься для них анонимными.",
                 reply_markup=ReplyKeyboardRemove(),
             )
     except Exception as e:
-        logging.error(f"Ошибка при создании топика: {e}")
+        logging.error("Ошибка при создании топика: %s", e)
+
+
+# Рассылка всем пользователям (только для администраторов группы):
+# /broadcast ответом на сообщение — разослать его копию, /broadcast текст — разослать текст,
+# /broadcast status — прогресс последней рассылки, /broadcast stop — остановить её
+@dp.message(Command("broadcast"), F.chat.type.in_(["group", "supergroup"]))
+async def broadcast_command(message: types.Message, command: CommandObject):
+    if message.chat.id not in GROUP_IDS:
+        return
+    member = await bot.get_chat_member(message.chat.id, message.from_user.id)
+    if member.status not in (ChatMemberStatus.CREATOR, ChatMemberStatus.ADMINISTRATOR):
+        await message.reply("Рассылка доступна только администраторам группы.")
+        return
+
+    args = (command.args or "").strip()
+    if args in ("status", "stop"):
+        if args == "stop" and await broadcaster.stop():
+            await message.reply("Рассылка остановлена.")
+            return
+        latest = await broadcaster.latest()
+        if latest is None:
+            await message.reply("Рассылок ещё не было.")
+            return
+        await broadcaster.report(latest)
+        return
+
+    replied_id = replied_message_id(message)
+    if replied_id is None and not args:
+        await message.reply("Ответьте командой /broadcast на сообщение для рассылки или напишите /broadcast текст.")
+        return
+    if (await broadcaster.latest() or {}).get("status") == "running":
+        await message.reply("Предыдущая рассылка ещё идёт: /broadcast status или /broadcast stop.")
+        return
+
+    if replied_id is not None:
+        broadcast_id = await broadcaster.create(
+            message.from_user.id, message.chat.id, message.message_thread_id,
+            source_chat_id=message.chat.id, source_message_id=replied_id,
+        )
+    else:
+        broadcast_id = await broadcaster.create(
+            message.from_user.id, message.chat.id, message.message_thread_id, text=args
+        )
+    await message.reply(f"Рассылка #{broadcast_id} запущена, отчёт придёт сюда.")
+    asyncio.create_task(broadcaster.run(broadcast_id))
 
 
 # Обработчик сообщений от пользователя
@@ -271,100 +3119,98 @@ async def handle_user_message(message: types.Message):
     if not message.from_user:
         logging.error("Отсутствует информация о пользователе")
         return
-    logging.info(
-        f"Сообщение от {message.from_user.id}: {message.text or 'мультимедиа'}"
-    )
+    # Текст сообщений в лог не пишем, только тип
+    relay_log.info("Сообщение от %s: %s", UserRef(message.from_user.id), message.content_type)
+
+    if message.media_group_id:
+        media_groups.add(message, relay_user_album)
+        return
+    # Незавершённый альбом пользователя уходит раньше следующего сообщения
+    await media_groups.flush_key(message_conversation_key(message))
 
     # Регистрируем пользователя и получаем данные
-    anon_id, topic_id = await register_user(message.from_user.id)
+    anon_id, group_id, topic_id = await register_user(message.from_user.id)
+    if group_id is None:
+        # Регистрация не удалась: отправлять некуда, ошибка уже в логе
+        await message.answer("Произошла ошибка при отправке сообщения.")
+        return
+    row_id = await get_user_row_id(message.from_user.id)
 
     try:
 
          # Формируем идентификатор для анонимности
         user_tag = f"Сообщение от {str(anon_id)[:4]}:"
 
-        # Отправляем разные типы сообщений
-        if message.text:
-            forward_message = f"{message.text}"
-            await safe_send(
-                bot.send_message,
-                chat_id=GROUP_ID,
-                message_thread_id=topic_id,
-                text=forward_message
-            )
-        elif message.photo:
-            await safe_send(
-                bot.send_photo,
-                chat_id=GROUP_ID,
-                message_thread_id=topic_id,
-                photo=message.photo[-1].file_id,
-                caption=f"{user_tag}\n{message.caption or ''}",
-            )
-        elif message.video:
-            await safe_send(
-                bot.send_video,
-                chat_id=GROUP_ID,
-                message_thread_id=topic_id,
-                video=message.video.file_id,
-                caption=f"{user_tag}\n{message.caption or ''}",
-            )
-        elif message.document:
-            await safe_send(
-                bot.send_document,
-                chat_id=GROUP_ID,
-                message_thread_id=topic_id,
-                document=message.document.file_id,
-                caption=f"{user_tag}\n{message.caption or ''}",
-            )
-        elif message.audio:
-            await safe_send(
-                bot.send_audio,
-                chat_id=GROUP_ID,
-                message_thread_id=topic_id,
-                audio=message.audio.file_id,
-                caption=f"{user_tag}\n{message.caption or ''}",
-            )
-        elif message.voice:
+        # Копируем сообщение любого поддерживаемого типа одним вызовом
+        if message.content_type in RELAYED_CONTENT_TYPES:
+            extra = await linked_reply(message, message_map.by_user, row_id)
+            if message.content_type in CAPTIONED_CONTENT_TYPES:
+                extra["caption"] = f"{user_tag}\n{message.caption or ''}"
             await safe_send(
-                bot.send_voice,
-                chat_id=GROUP_ID,
+                bot.copy_message,
+                link=message_link(row_id, group_id, user_message_ids=[message.message_id]),
+                notify_chat_id=message.chat.id,
+                chat_id=group_id,
                 message_thread_id=topic_id,
-                voice=message.voice.file_id,
-                caption=user_tag,
+                from_chat_id=message.chat.id,
+                message_id=message.message_id,
+                **extra,
             )
         else:
             await safe_send(
                 bot.send_message,
-                chat_id=GROUP_ID,
+                notify_chat_id=message.chat.id,
+                chat_id=group_id,
                 message_thread_id=topic_id,
                 text=f"{user_tag}\nТип сообщения пока не поддерживается.",
             )
 
     except Exception as e:
-        logging.error(f"Ошибка при обработке сообщения от пользователя: {e}")
+        logging.error("Ошибка при обработке сообщения от пользователя: %s", e)
         await message.answer("Произошла ошибка при отправке сообщения.")
 
 
+# Пересылка альбома пользователя в его топик
+@metrics.timed("bot_handler_duration_seconds", handler="relay_user_album")
+async def relay_user_album(messages):
+    first = messages[0]
+    anon_id, group_id, topic_id = await register_user(first.from_user.id)
+    if group_id is None:
+        await first.answer("Произошла ошибка при отправке сообщения.")
+        return
+    row_id = await get_user_row_id(first.from_user.id)
+    user_tag = f"Сообщение от {str(anon_id)[:4]}:"
+    try:
+        await safe_send(
+            bot.send_media_group,
+            link=message_link(row_id, group_id, user_message_ids=[message.message_id for message in messages]),
+            notify_chat_id=first.chat.id,
+            chat_id=group_id,
+            message_thread_id=topic_id,
+            media=album_media(messages, f"{user_tag}\n{first.caption or ''}"),
+            **await linked_reply(first, message_map.by_user, row_id),
+        )
+    except Exception as e:
+        logging.error("Ошибка при обработке альбома от пользователя: %s", e)
+        await first.answer("Произошла ошибка при отправке сообщения.")
+
+
 # Обработка новых сообщений администратора
 @dp.message(F.chat.type.in_(["group", "supergroup"]) & ~F.text.startswith("/"))
 async def handle_admin_reply(message: types.Message):
     """
-    Обрабатывает только текстовые сообщения от администратора в топиках группы,
-    игнорируя команды.
-    """
-    if not any(
-        [
-            message.text,
-            message.photo,
-            message.video,
-            message.document,
-            message.audio,
-            message.voice,
-        ]
-    ):
-        logging.info(f"Игнорирование пустого сообщения или команды: {message.text}")
+    Обрабатывает сообщения администратора в топиках группы,
+    игнорируя команды и служебные сообщения.
+    """
+    if message.content_type not in RELAYED_CONTENT_TYPES:
+        logging.info("Игнорирование служебного сообщения: %s", message.content_type)
         return
 
+    if message.media_group_id:
+        media_groups.add(message, relay_admin_album)
+        return
+    await media_groups.flush_key(message_conversation_key(message))
+
         # Обрабатываем сообщение
     await process_admin_message(message)
 
@@ -375,103 +3221,229 @@ async def handle_admin_edited_message(message: types.Message):
 
     topic_id = message.message_thread_id
 
-    # Проверяем, существует ли topic_id в базе
-    async with db_pool2.acquire() as conn:
-        result = await conn.fetchrow(
-            f"SELECT telegram_id FROM {TABLE_NAME} WHERE topic_id = $1", topic_id
-        )
+    # Проверяем, существует ли топик этой группы в базе
+    telegram_id = await get_telegram_id_by_topic(message.chat.id, topic_id)
 
-    if not result:
+    if not telegram_id:
         logging.warning(
-            f"Редактирование сообщения в несуществующем топике: {topic_id}. Игнорируем."
+            "Редактирование сообщения в несуществующем топике: %s. Игнорируем.", topic_id
         )
         return  # Игнорируем редактирование, если пользователь не зарегистрирован
 
-    # Если пользователь найден, продолжаем обработку
-    await process_admin_message(message)
+    # Правим копию у пользователя; если связь не сохранилась, отправляем новую копию
+    row_id = await get_user_row_id(telegram_id)
+    linked = await message_map.by_group(message.chat.id, message.message_id)
+    if linked is None or linked[0] != row_id:
+        await process_admin_message(message)
+        return
+
+    try:
+        if message.text is not None:
+            await safe_send(
+                bot.edit_message_text,
+                chat_id=telegram_id,
+                message_id=linked[1],
+                text=message.text,
+                entities=message.entities,
+            )
+        elif message.content_type in CAPTIONED_CONTENT_TYPES:
+            await safe_send(
+                bot.edit_message_caption,
+                chat_id=telegram_id,
+                message_id=linked[1],
+                caption=message.caption,
+                caption_entities=message.caption_entities,
+            )
+        else:
+            logging.info("Правка сообщения типа %s не пересылается", message.content_type)
+    except Exception as e:
+        logging.error("Ошибка при пересылке правки администратора: %s", e)
 
 
 # Общая функция обработки сообщений
+@metrics.timed("bot_handler_duration_seconds", handler="process_admin_message")
 async def process_admin_message(message: types.Message):
     """
     Обрабатывает как новые, так и редактированные сообщения от администратора.
     """
-    logging.info(
-        f"Обработка сообщения от администратора: {message.text}, чат: {message.chat.id}"
+    relay_log.info(
+        "Обработка сообщения от администратора: %s, топик: %s", message.content_type, message.message_thread_id
     )
     # Получаем topic_id из текущего чата
     topic_id = message.message_thread_id
 
-    # Находим зашифрованный Telegram ID пользователя, связанного с этим topic_id
-    async with db_pool2.acquire() as conn:
-        result = await conn.fetchrow(
-            f"SELECT telegram_id FROM {TABLE_NAME} WHERE topic_id = $1", topic_id
-        )
+    # Находим Telegram ID пользователя по группе и topic_id (сначала в кэше)
+    telegram_id = await get_telegram_id_by_topic(message.chat.id, topic_id)
 
-    if not result:
+    if not telegram_id:
         logging.error("Пользователь с данным topic_id не найден")
         return
 
-    # Дешифруем Telegram ID для последующего использования
-    telegram_id = decrypt_telegram_id(result["telegram_id"])
-
     try:
-        # Пересылаем сообщение пользователю в зависимости от типа контента
-        if message.photo:
-            await safe_send(
-                bot.send_photo,
-                chat_id=telegram_id,
-                photo=message.photo[-1].file_id,
-                caption=message.caption,
-            )
-        elif message.video:
-            await safe_send(
-                bot.send_video,
-                chat_id=telegram_id,
-                video=message.video.file_id,
-                caption=message.caption,
-            )
-        elif message.document:
-            await safe_send(
-                bot.send_document,
-                chat_id=telegram_id,
-                document=message.document.file_id,
-                caption=message.caption,
-            )
-        elif message.audio:
-            await safe_send(
-                bot.send_audio,
-                chat_id=telegram_id,
-                audio=message.audio.file_id,
-                caption=message.caption,
-            )
-        elif message.voice:
-            await safe_send(
-                bot.send_voice,
-                chat_id=telegram_id,
-                voice=message.voice.file_id,
-                caption=message.caption,
-            )
-        elif message.text:
-            await safe_send(
-                bot.send_message,
-                chat_id=telegram_id,
-                text=f"\n\n{message.text}"
-            )
+        # Копируем сообщение пользователю одним вызовом, независимо от типа контента
+        row_id = await get_user_row_id(telegram_id)
+        await safe_send(
+            bot.copy_message,
+            link=message_link(row_id, message.chat.id, group_message_ids=[message.message_id]),
+            chat_id=telegram_id,
+            from_chat_id=message.chat.id,
+            message_id=message.message_id,
+            **await linked_reply(message, message_map.by_group, message.chat.id),
+        )
 
-        logging.info(f"Ответ успешно отправлен пользователю с ID {telegram_id}")
+        relay_log.info("Ответ успешно отправлен пользователю %s", UserRef(telegram_id))
 
     except Exception as e:
-        logging.error(f"Ошибка при обработке ответа администратора: {e}")
+        logging.error("Ошибка при обработке ответа администратора: %s", e)
         await message.reply("Произошла ошибка при отправке ответа пользователю.")
 
 
+# Пересылка альбома администратора пользователю
+@metrics.timed("bot_handler_duration_seconds", handler="relay_admin_album")
+async def relay_admin_album(messages):
+    first = messages[0]
+    telegram_id = await get_telegram_id_by_topic(first.chat.id, first.message_thread_id)
+    if not telegram_id:
+        logging.error("Пользователь с данным topic_id не найден")
+        return
+    try:
+        row_id = await get_user_row_id(telegram_id)
+        await safe_send(
+            bot.send_media_group,
+            link=message_link(row_id, first.chat.id, group_message_ids=[message.message_id for message in messages]),
+            chat_id=telegram_id,
+            media=album_media(messages),
+            **await linked_reply(first, message_map.by_group, first.chat.id),
+        )
+    except Exception as e:
+        logging.error("Ошибка при обработке альбома администратора: %s", e)
+        await first.reply("Произошла ошибка при отправке ответа пользователю.")
+
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # 0 — не запускать
+
+
+# Значения, которые снимаются в момент запроса метрик
+async def collect_runtime_metrics():
+    if db_pool2 is not None:
+        metrics.set("db_pool_connections", db_pool2.get_size() - db_pool2.get_idle_size(), state="in_use")
+        metrics.set("db_pool_connections", db_pool2.get_idle_size(), state="idle")
+        try:
+            outbox_stats = await outbox.stats()
+            metrics.set("retry_queue_depth", outbox_stats["pending"], queue="outbox")
+            metrics.set("retry_queue_oldest_age_seconds", outbox_stats["oldest_age"], queue="outbox")
+            metrics.set("retry_dead_letters", outbox_stats["dead"], queue="outbox")
+        except Exception as e:
+            logging.error("Не удалось получить состояние outbox: %s", e)
+    metrics.set("retry_queue_depth", len(retry_scheduler), queue="memory")
+    metrics.set("retry_queue_oldest_age_seconds", retry_scheduler.oldest_age(), queue="memory")
+    metrics.set("retry_dead_letters", len(retry_scheduler.dead_letters), queue="memory")
+
+    metrics.set("topics_dead", len(topic_reconciler.dead))
+    for group_id, users in group_router.loads.items():
+        metrics.set("forum_group_users", users, group=group_id)
+
+    cache_stats = identity_cache.stats()
+    metrics.set("identity_cache_size", cache_stats["size"])
+    metrics.set("identity_cache_requests", cache_stats["hits"], result="hit")
+    metrics.set("identity_cache_requests", cache_stats["misses"], result="miss")
+    metrics.set("identity_cache_hit_ratio", cache_stats["hit_ratio"])
+
+    limiter_stats = send_rate_limiter.stats()
+    metrics.set("send_queue_waiting", limiter_stats["waiting"])
+    metrics.set("send_queue_wait_seconds", limiter_stats["avg_wait"], stat="avg")
+    metrics.set("send_queue_wait_seconds", limiter_stats["max_wait"], stat="max")
+    metrics.set("conversation_queues_active", len(conversation_scheduler))
+
+    breaker_stats = api_breaker.stats()
+    for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN):
+        metrics.set("bot_api_circuit_state", int(breaker_stats["state"] == state), state=state)
+    metrics.set("bot_api_circuit_window_calls", breaker_stats["calls"], result="total")
+    metrics.set("bot_api_circuit_window_calls", breaker_stats["failures"], result="failed")
+    metrics.set("bot_api_circuit_rejected", breaker_stats["rejected"])
+    metrics.set("media_groups_pending", len(media_groups))
+
+    map_stats = message_map.stats()
+    metrics.set("message_map_cache_size", map_stats["size"])
+    metrics.set("message_map_requests", map_stats["hits"], result="hit")
+    metrics.set("message_map_requests", map_stats["misses"], result="miss")
+
+
+async def metrics_endpoint(request):
+    await collect_runtime_metrics()
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+# Небольшой локальный HTTP-сервер для Prometheus
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_endpoint)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info("Метрики доступны на http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
+
+# Проверка состояния для балансировщика нагрузки
+async def health(request):
+    status = "ok" if db_pool2 is not None else "starting"
+    return web.json_response({"status": status, "mode": BOT_MODE, "telegram_api": api_breaker.state})
+
+
+# Приложение aiohttp для приёма обновлений через webhook
+def create_webhook_app(path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    """
+    Telegram получает ответ сразу, а обновление обрабатывается в фоне
+    на том же event loop. Запросы без верного секретного токена отклоняются.
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=secret, handle_in_background=True
+    ).register(app, path=path)
+    app.router.add_get("/health", health)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(stop_event: asyncio.Event):
+    """Обслуживает webhook, пока не установлен stop_event (SIGINT/SIGTERM)."""
+    if not WEBHOOK_SECRET:
+        raise ValueError("WEBHOOK_SECRET обязателен в режиме webhook")
+
+    # Без WEBHOOK_URL адрес регистрируется вручную (например, один раз на весь кластер)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info("Webhook установлен: %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logging.info("Webhook-сервер запущен на %s:%s", WEBHOOK_HOST, WEBHOOK_PORT)
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        logging.info("Webhook-сервер остановлен")
+
+
 # Инициализация пула и запуск бота
 async def main():
     global db_pool2
 
     async def shutdown():
         if db_pool2:
+            await outbox.flush()
+            await message_map.flush()
             await db_pool2.close()
             logging.info("Пул db_pool2 закрыт")
         await bot.session.close()
@@ -482,23 +3454,58 @@ async def main():
         logging.info("Пул db_pool2 успешно создан")
 
         # Тестовый запрос
-        async with db_pool2.acquire() as conn:
+        async with db_acquire() as conn:
             await conn.execute("SELECT 1")
             logging.info("Подключение к базе данных успешно установлено")
 
-        await log_pool_state()  # Логирование состояния пула
+        await run_migrations()
+        await backfill_blind_index()
+        await message_map.maintain()
+        await topic_reconciler.load_replacements()
 
-        # Запускаем фоновую задачу для повторной отправки сообщений
-        asyncio.create_task(process_retry_queue())
-
-        loop = asyncio.get_running_loop()
-        for sig in (signal.SIGINT, signal.SIGTERM):
-            loop.add_signal_handler(sig, lambda: asyncio.create_task(shutdown()))
+        await log_pool_state()  # Логирование состояния пула
 
-        await dp.start_polling(bot)
+        if METRICS_PORT:
+            await start_metrics_server()
+
+        # Запускаем фоновые задачи для повторной отправки сообщений:
+        # outbox в базе и резервную очередь в памяти на случай недоступности базы
+        outbox.start()
+        message_map.start()
+        asyncio.create_task(retry_scheduler.run())
+        # Сброс кэшей при изменениях, сделанных другими экземплярами
+        asyncio.create_task(cluster_events.run(DATABASE_URL, CLUSTER_CHANNEL))
+        # Продолжение рассылок, прерванных перезапуском
+        asyncio.create_task(broadcaster.run_resumer())
+        # Удалённые топики ищутся и пересоздаются в фоне
+        topic_reconciler.start(DATABASE_URL)
+        # Число пользователей по группам (для least_loaded и метрик)
+        asyncio.create_task(group_router.run(GROUP_LOAD_REFRESH))
+
+        if BOT_MODE == "webhook":
+            # Сигнал останавливает сервер, после чего пул и сессия закрываются
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop_event.set)
+            await run_webhook(stop_event)
+        else:
+            # Webhook, оставшийся от прошлого запуска, мешает long polling.
+            # start_polling сам обрабатывает SIGINT/SIGTERM и возвращает управление.
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except Exception as e:
-        logging.error(f"Ошибка при подключении к базе данных: {e}")
+        logging.error("Ошибка при подключении к базе данных: %s", e)
+    finally:
+        # Буферы outbox и связей сообщений записываются при любом завершении
+        await shutdown()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if sys.argv[1:] == ["rotate-key"]:
+        # python main.py rotate-key: ENCRYPTION_KEY_OLD -> ENCRYPTION_KEY
+        if not ENCRYPTION_KEY_OLD:
+            raise ValueError("Для ротации задайте ENCRYPTION_KEY_OLD")
+        asyncio.run(rotate_encryption_key(ENCRYPTION_KEY_OLD, ENCRYPTION_KEY))
+    else:
+        asyncio.run(main())
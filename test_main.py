@@ -1,5 +1,20 @@
+import asyncio
+import json
+import logging
+import time
+
 import pytest
-from main import encrypt_telegram_id, decrypt_telegram_id
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import types
+import main
+from main import (
+    encrypt_telegram_id, decrypt_telegram_id, decrypt_telegram_ids, IdentityCache, single_flight,
+    RetryScheduler, TokenBucket, create_webhook_app, KeyedScheduler,
+    MediaGroupBuffer, album_media, blind_index,
+    MIGRATIONS, Metrics, parse_method_timeouts, load_json_codec, TunedAiohttpSession,
+    MessageMap, CircuitBreaker, CircuitOpenError, UserRef, SamplingFilter, JsonFormatter, GroupRouter,
+    TopicReconciler, redirect_to_live_topic, seal_user_ids, open_user_ids,
+)
 
 # Тестовые данные
 TEST_TELEGRAM_ID = "123456789"
@@ -18,4 +33,482 @@ def test_encrypt_decrypt_telegram_id():
     decrypted_id = decrypt_telegram_id(encrypted_id)
 
     # Проверяем, что после дешифрования получаем исходный идентификатор
-    assert decrypted_id == TEST_TELEGRAM_ID
\ No newline at end of file
+    assert decrypted_id == TEST_TELEGRAM_ID
+
+def test_identity_cache_lookups_and_invalidation():
+    cache = IdentityCache(max_size=2, ttl=60)
+    cache.put("1", 10, "aaaa-1", 100)
+    cache.put("2", 20, "bbbb-2", 200)
+
+    assert cache.get_by_topic(200) == "2"
+    assert cache.get("1").topic_id == 100
+    assert cache.get_by_anon("aaaa-1") == "1"
+
+    # Третья запись вытесняет наименее используемую ("2")
+    cache.put("3", 30, "cccc-3", 300)
+    assert cache.get("2") is None
+    assert cache.get_by_topic(200) is None
+
+    # Смена топика: старый topic_id больше не указывает на пользователя
+    cache.invalidate(telegram_id="1", topic_id=100)
+    assert cache.get_by_topic(100) is None
+    assert cache.stats()["hits"] == 3
+
+
+def test_identity_cache_ttl():
+    cache = IdentityCache(max_size=10, ttl=0)
+    cache.put("1", 10, "aaaa-1", 100)
+    assert cache.get("1") is None
+    assert len(cache) == 0
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def run():
+        return await asyncio.gather(
+            *(single_flight(("register", "1"), create) for _ in range(5))
+        )
+
+    assert asyncio.run(run()) == [1] * 5
+    assert len(calls) == 1
+
+
+def test_retry_scheduler_backoff_and_dead_letter():
+    attempts = {"ok": 0, "fail": 0}
+
+    async def flaky(**kwargs):
+        attempts["ok"] += 1
+        if attempts["ok"] < 3:
+            raise RuntimeError("network error")
+
+    async def broken(**kwargs):
+        attempts["fail"] += 1
+        raise RuntimeError("network error")
+
+    async def run():
+        scheduler = RetryScheduler(max_attempts=3, base_delay=0.001, max_delay=0.01)
+        worker = asyncio.create_task(scheduler.run())
+        scheduler.schedule(flaky, {"chat_id": 1})
+        scheduler.schedule(broken, {"chat_id": 2})
+        await asyncio.sleep(0.2)
+        worker.cancel()
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert attempts == {"ok": 3, "fail": 3}
+    assert len(scheduler) == 0
+    assert [item["kwargs"] for item in scheduler.dead_letters] == [{"chat_id": 2}]
+
+
+def test_token_bucket_reserves_in_order():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    # Дальше каждый следующий ждёт на 1/rate дольше предыдущего
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+
+def test_webhook_checks_secret_and_accepts_updates():
+    # Обновление, для которого нет обработчиков: проверяем только приём
+    update = {
+        "update_id": 1,
+        "channel_post": {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": -100, "type": "channel"},
+            "text": "test",
+        },
+    }
+
+    async def run():
+        async with TestClient(TestServer(create_webhook_app("/webhook", "s3cret"))) as client:
+            health = await client.get("/health")
+            denied = await client.post(
+                "/webhook", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+            )
+            accepted = await client.post(
+                "/webhook", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+            )
+            return health.status, denied.status, accepted.status
+
+    assert asyncio.run(run()) == (200, 401, 200)
+
+
+def test_keyed_scheduler_orders_within_key_and_reaps_idle_keys():
+    events = []
+
+    def job(key, index, delay):
+        async def run():
+            await asyncio.sleep(delay)
+            events.append((key, index))
+            return index
+        return run
+
+    async def run():
+        scheduler = KeyedScheduler()
+        futures = [
+            scheduler.submit("a", job("a", 1, 0.03)),
+            scheduler.submit("a", job("a", 2, 0)),
+            scheduler.submit("b", job("b", 1, 0.01)),
+        ]
+        assert len(scheduler) == 2
+        results = await asyncio.gather(*futures)
+        await asyncio.sleep(0)
+        return results, len(scheduler)
+
+    results, active_keys = asyncio.run(run())
+    assert results == [1, 2, 1]
+    # "b" не ждёт "a", а внутри "a" порядок сохраняется
+    assert events == [("b", 1), ("a", 1), ("a", 2)]
+    assert active_keys == 0
+
+
+def test_media_group_buffer_relays_album_once():
+    def photo(message_id, caption=None):
+        return types.Message(
+            message_id=message_id,
+            date=0,
+            chat=types.Chat(id=1, type="private"),
+            media_group_id="album",
+            photo=[types.PhotoSize(file_id=f"file{message_id}", file_unique_id=f"u{message_id}", width=1, height=1)],
+            caption=caption,
+        )
+
+    batches = []
+
+    async def relay(messages):
+        batches.append(album_media(messages, "tag"))
+
+    async def run():
+        buffer = MediaGroupBuffer(KeyedScheduler(), window=0.01)
+        for message in (photo(2), photo(1, "caption"), photo(3)):
+            buffer.add(message, relay)
+        await asyncio.sleep(0.05)
+        return len(buffer)
+
+    assert asyncio.run(run()) == 0
+    assert len(batches) == 1
+    assert [item.media for item in batches[0]] == ["file1", "file2", "file3"]
+    assert [item.caption for item in batches[0]] == ["tag", None, None]
+
+
+def test_blind_index_and_key_rotation_primitives():
+    # Слепой индекс детерминирован и не зависит от ключа шифрования
+    assert blind_index(TEST_TELEGRAM_ID) == blind_index(int(TEST_TELEGRAM_ID))
+    assert blind_index(TEST_TELEGRAM_ID) != blind_index("987654321")
+
+    new_key = b"fedcba9876543210"
+    encrypted_id = encrypt_telegram_id(TEST_TELEGRAM_ID, key=new_key)
+    assert encrypted_id != encrypt_telegram_id(TEST_TELEGRAM_ID)
+    # Кэшированный объект шифра можно использовать повторно
+    assert encrypt_telegram_id(TEST_TELEGRAM_ID, key=new_key) == encrypted_id
+    assert decrypt_telegram_id(encrypted_id, key=new_key) == TEST_TELEGRAM_ID
+
+
+def test_decrypt_telegram_ids_in_bulk():
+    ids = ["1", "123456789", "12345678901234567"]
+    encrypted = [encrypt_telegram_id(value) for value in ids]
+    # Повреждённое и чужое значения не ломают расшифровку остальных
+    broken = [encrypted[0], "AAAA", encrypt_telegram_id("999", key=b"fedcba9876543210")] + encrypted[1:]
+    assert decrypt_telegram_ids(encrypted) == ids
+    assert decrypt_telegram_ids(broken) == ["1", None, None, "123456789", "12345678901234567"]
+
+
+def test_migrations_have_increasing_versions():
+    versions = [version for version, _, _ in MIGRATIONS]
+    assert versions == sorted(set(versions))
+
+
+def test_metrics_render_prometheus_text():
+    registry = Metrics(buckets=(0.1, 1.0))
+    registry.describe("handler_seconds", "histogram", "Время обработки")
+    registry.observe("handler_seconds", 0.05, handler="a")
+    registry.observe("handler_seconds", 0.5, handler="a")
+    registry.inc("errors_total", error="TelegramBadRequest")
+    registry.set("queue_depth", 3, queue="memory")
+
+    text = registry.render()
+    assert "# TYPE handler_seconds histogram" in text
+    assert 'handler_seconds_bucket{handler="a",le="0.1"} 1' in text
+    assert 'handler_seconds_bucket{handler="a",le="+Inf"} 2' in text
+    assert 'handler_seconds_count{handler="a"} 2' in text
+    assert 'errors_total{error="TelegramBadRequest"} 1' in text
+    assert 'queue_depth{queue="memory"} 3' in text
+    assert registry.total("handler_seconds") == 2
+
+
+def test_bot_session_settings():
+    assert parse_method_timeouts("sendMediaGroup=120, copyMessage=20,") == {
+        "sendMediaGroup": 120.0, "copyMessage": 20.0,
+    }
+    # Неизвестный кодек заменяется стандартным json
+    name, loads, dumps = load_json_codec("missing-codec")
+    assert name == "json" and loads(dumps({"a": 1})) == {"a": 1}
+    name, loads, dumps = load_json_codec("auto")
+    assert isinstance(dumps({"text": "привет"}), str)
+
+    async def connector_limits():
+        session = TunedAiohttpSession(limit=10, keepalive_timeout=30, method_timeouts={"sendVideo": 120})
+        assert session.method_timeouts == {"sendVideo": 120}
+        client = await session.create_session()
+        try:
+            return client.connector.limit, client.connector.limit_per_host
+        finally:
+            await session.close()
+
+    assert asyncio.run(connector_limits()) == (10, 10)
+
+
+def test_message_map_links_both_directions():
+    async def run():
+        links = MessageMap("messages", max_size=2)
+        links.add(1, 10, "-100", 500)
+        links.add(2, 20, -100, 600)
+        found = (await links.by_group(-100, 500), await links.by_user(2, 20))
+        # Третья связь вытесняет наименее используемую: в индексе топика это 600
+        links.add(3, 30, -100, 700)
+        missing = await links.by_group(-100, 600)
+        return found, missing, links.stats()
+
+    found, missing, stats = asyncio.run(run())
+    assert found == ((1, 10), (-100, 600))
+    assert missing is None
+    assert stats["size"] == 2 and stats["hits"] == 2 and stats["misses"] == 1
+
+
+def test_message_link_is_recorded_after_delayed_send(monkeypatch):
+    links = MessageMap("messages")
+    monkeypatch.setattr(main, "message_map", links)
+    # Связь переживает запись в outbox вместе с параметрами отправки
+    user_side = json.loads(json.dumps(main.message_link(7, -100, user_message_ids=[10])))
+    main.record_message_link(user_side, types.MessageId(message_id=500))
+    album = main.message_link(7, -100, group_message_ids=[600, 601])
+    main.record_message_link(album, [types.MessageId(message_id=20), types.MessageId(message_id=21)])
+    main.record_message_link(album, None)
+    assert main.message_link(None, -100, user_message_ids=[1]) is None
+
+    async def lookups():
+        return (await links.by_group(-100, 500), await links.by_user(7, 21))
+
+    assert asyncio.run(lookups()) == ((7, 10), (-100, 601))
+
+
+def test_circuit_breaker_opens_probes_and_closes():
+    breaker = CircuitBreaker(window=60, min_calls=4, failure_rate=0.5, open_seconds=0.05)
+    assert breaker.should_notify(1) and not breaker.should_notify(1)
+
+    for failed in (False, True, False, True):
+        assert breaker.before_request() is False
+        breaker.record(failed)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    # Во время одного сбоя чат предупреждается только один раз
+    assert not breaker.should_notify(1)
+
+    with pytest.raises(CircuitOpenError):
+        breaker.fail_fast()
+
+    time.sleep(0.06)
+    # Пробный запрос ещё не выбран: запросы проходят к ограничителю частоты
+    breaker.fail_fast()
+    assert breaker.before_request() is True  # пробный запрос
+    with pytest.raises(CircuitOpenError):
+        breaker.fail_fast()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    breaker.record(False, probe=True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.fail_fast()
+    assert breaker.stats()["rejected"] == 4
+    # После восстановления следующий сбой снова можно объявить
+    assert breaker.should_notify(1)
+
+
+def test_log_sampling_and_redaction():
+    def record(name, level, *args):
+        return logging.LogRecord(name, level, __file__, 1, "Сообщение от %s", args, None)
+
+    sampler = SamplingFilter({"bot.relay": "0"})
+    assert not sampler.filter(record("bot.relay.user", logging.INFO))
+    # Предупреждения и другие логгеры не прореживаются
+    assert sampler.filter(record("bot.relay", logging.WARNING))
+    assert sampler.filter(record("aiogram", logging.INFO))
+    assert sampler.dropped == 1
+
+    line = JsonFormatter().format(record("bot.relay", logging.INFO, UserRef(TEST_TELEGRAM_ID)))
+    entry = json.loads(line)
+    assert entry["level"] == "INFO" and entry["logger"] == "bot.relay"
+    assert TEST_TELEGRAM_ID not in line
+    assert entry["message"] == f"Сообщение от {UserRef(int(TEST_TELEGRAM_ID))}"
+
+    # Аргументы фиксируются при постановке в очередь, UserRef остаётся ленивым
+    handler = main.LoopQueueHandler(None)
+    state = {"step": 1}
+    user = UserRef(TEST_TELEGRAM_ID)
+    queued = logging.LogRecord("bot", logging.INFO, __file__, 1, "%s: %d%% %r", (user, 50, state), None)
+    handler.prepare(queued)
+    state["step"] = 2
+    assert queued.args == (user,)
+    assert queued.getMessage() == f"{user}: 50% {{'step': 1}}"
+    plain = logging.LogRecord("bot", logging.INFO, __file__, 1, "%s", (state,), None)
+    handler.prepare(plain)
+    state["step"] = 3
+    assert plain.getMessage() == "{'step': 2}"
+
+
+def test_group_router_assigns_new_users_only():
+    keys = [blind_index(str(telegram_id)) for telegram_id in range(2000)]
+    router = GroupRouter({-1001: 1, -1002: 1})
+    before = [router.assign(key) for key in keys]
+    assert before == [router.assign(key) for key in keys]
+    assert 700 < before.count(-1001) < 1300
+
+    # Новая группа забирает только свою долю, остальные пользователи не переезжают
+    grown = GroupRouter({-1001: 1, -1002: 1, -1003: 1})
+    after = [grown.assign(key) for key in keys]
+    assert all(old == new for old, new in zip(before, after) if new != -1003)
+    assert 400 < after.count(-1003) < 950
+
+    # Группа с весом 0 больше не получает новых пользователей
+    closed = GroupRouter({-1001: 0, -1002: 1})
+    assert {closed.assign(key) for key in keys} == {-1002}
+
+    least = GroupRouter({-1001: 1, -1002: 2, -1003: 0}, strategy="least_loaded")
+    least.loads = {-1001: 10, -1002: 10, -1003: 0}
+    assert least.assign(keys[0]) == -1002
+    for _ in range(10):
+        least.record(least.assign(keys[0]))
+    assert least.loads == {-1001: 10, -1002: 20, -1003: 0}
+
+    # Номера топиков различаются только внутри группы
+    cache = IdentityCache(max_size=10, ttl=60)
+    cache.put("1", 10, "aaaa-1", 5, -1001)
+    cache.put("2", 20, "bbbb-2", 5, -1002)
+    assert cache.get_by_topic(5, -1001) == "1"
+    assert cache.get_by_topic(5, "-1002") == "2"
+    cache.invalidate(topic_id=5, group_id=-1001)
+    assert cache.get_by_topic(5, -1001) is None
+    assert cache.get_by_topic(5, -1002) == "2"
+
+
+def test_dead_topic_waits_for_background_replacement(monkeypatch):
+    reconciler = TopicReconciler("topic_replacements")
+    monkeypatch.setattr(main, "topic_reconciler", reconciler)
+    monkeypatch.setattr(main, "topic_replacements", main.OrderedDict())
+
+    assert reconciler.mark_dead(-1001, 5)
+    assert reconciler.mark_dead("-1001", 5)
+    assert not reconciler.mark_dead(None, 5)
+    assert not reconciler.mark_dead(-1001, None)
+    assert reconciler.stats()["pending"] == 1
+
+    # Пока топик не пересоздан, отправка в него откладывается; тот же номер в другой группе жив
+    kwargs = {"chat_id": "-1001", "message_thread_id": 5, "text": "привет"}
+    assert not redirect_to_live_topic(kwargs)
+    assert redirect_to_live_topic({"chat_id": -1002, "message_thread_id": 5})
+    assert redirect_to_live_topic({"chat_id": 42, "text": "личное сообщение"})
+
+    # Замена (своя или от другого экземпляра) снимает топик с очереди и перенаправляет сообщения
+    reconciler.apply([[-1001, 5, 9]])
+    assert reconciler.stats()["dead"] == reconciler.stats()["pending"] == 0
+    assert redirect_to_live_topic(kwargs)
+    assert kwargs["message_thread_id"] == 9
+
+    # Цепочка пересозданий проходится сразу до последнего топика
+    reconciler.apply([[-1001, 9, 12]])
+    chained = {"chat_id": -1001, "message_thread_id": 5}
+    assert redirect_to_live_topic(chained)
+    assert chained["message_thread_id"] == 12
+
+    # Пересоздание, которое всё время падает, ограничено попытками
+    stubborn = TopicReconciler("topic_replacements", max_attempts=2)
+    monkeypatch.setattr(main, "topic_reconciler", stubborn)
+    key = main.topic_key(-1001, 7)
+    assert stubborn.mark_dead(-1001, 7)
+    stubborn._postpone(key)
+    assert key in stubborn.dead and stubborn._pending[key] > time.monotonic()
+    stubborn._postpone(key)
+    assert stubborn.stats()["dead"] == stubborn.stats()["pending"] == 0
+    # После отказа сообщения в топик не ждут замены, а расходуют попытки
+    assert stubborn.mark_dead(-1001, 7) and key not in stubborn.dead
+    assert redirect_to_live_topic({"chat_id": -1001, "message_thread_id": 7})
+
+
+def test_outbox_payload_keeps_user_ids_encrypted():
+    kwargs = {"chat_id": -1001, "from_chat_id": 123456789, "message_id": 7, "message_thread_id": 5}
+    sealed = seal_user_ids(kwargs)
+    assert "from_chat_id" not in sealed and "123456789" not in json.dumps(sealed)
+    assert sealed["chat_id"] == -1001
+    assert open_user_ids(json.loads(json.dumps(sealed))) == kwargs
+
+    reply = seal_user_ids({"chat_id": "123456789", "text": "ответ"})
+    assert "chat_id" not in reply
+    assert open_user_ids(reply) == {"chat_id": 123456789, "text": "ответ"}
+
+    # Строку, которую нельзя расшифровать, повторять бессмысленно
+    foreign = seal_user_ids({"chat_id": 123456789, "text": "ответ"})
+    foreign["chat_id_encrypted"] = encrypt_telegram_id("123456789", key=b"another-key-0000")
+    row = {"id": 1, "method": "send_message", "payload": json.dumps(foreign), "attempts": 1}
+    status, row_id, _, error = asyncio.run(main.Outbox("outbox")._deliver(row))
+    assert (status, row_id) == ("dead", 1) and error
+
+
+def test_failed_registration_answers_without_relaying(monkeypatch):
+    async def failed_registration(telegram_id):
+        return None, None, None
+
+    sent = []
+
+    async def fake_send(*args, **kwargs):
+        sent.append(kwargs)
+
+    class FakeMessage:
+        from_user = types.User(id=123456789, is_bot=False, first_name="u")
+        chat = types.Chat(id=123456789, type="private")
+        content_type = "text"
+        media_group_id = None
+        message_id = 1
+        answers = []
+
+        async def answer(self, text):
+            self.answers.append(text)
+
+    monkeypatch.setattr(main, "register_user", failed_registration)
+    monkeypatch.setattr(main, "safe_send", fake_send)
+    message = FakeMessage()
+    asyncio.run(main.handle_user_message(message))
+    asyncio.run(main.relay_user_album([message]))
+    assert sent == []
+    assert message.answers == ["Произошла ошибка при отправке сообщения."] * 2
+
+
+def test_network_notice_goes_to_the_author_once(monkeypatch):
+    notices, queued = [], []
+
+    async def broken_send(**kwargs):
+        raise RuntimeError("Connection reset")
+
+    async def fake_notice(chat_id, text):
+        notices.append(chat_id)
+
+    monkeypatch.setattr(main, "api_breaker", CircuitBreaker())
+    monkeypatch.setattr(main.bot, "send_message", fake_notice)
+    monkeypatch.setattr(main.outbox, "enqueue", lambda *args, **kwargs: queued.append(args))
+
+    async def run():
+        for _ in range(2):
+            await main.safe_send(broken_send, notify_chat_id=123456789, chat_id=-1001, message_thread_id=5)
+        # Ответ администратора без автора-пользователя никого не предупреждает
+        await main.safe_send(broken_send, chat_id=123456789)
+
+    asyncio.run(run())
+    assert notices == [123456789]
+    assert len(queued) == 3